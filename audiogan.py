@@ -8,6 +8,10 @@ import torch.nn as NN
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from torch.nn.utils import weight_norm as torch_weight_norm
+try:
+    from torch.utils.checkpoint import checkpoint as recompute
+except ImportError:
+    recompute = None
 
 import numpy as NP
 import numpy.random as RNG
@@ -20,6 +24,14 @@ import os
 
 from timer import Timer
 import dataset
+import checkpoint
+import gradient
+from perturbation import Perturbation
+import distributed
+import compiled
+import bufferpool
+import evaluation
+import validation
 
 import matplotlib
 from librosa import feature
@@ -91,77 +103,65 @@ class LayerNorm(NN.Module):
         std = x.std(-1, keepdim=True)
         return self.gamma * (x - mean) / (std + self.eps) + self.beta
 
+use_cuda = T.cuda.is_available()
+# Buffers of the training batches, recycled after every optimizer step
+batch_pool = None
+
+def cuda(x):
+    return x.cuda() if use_cuda else x
+
 def tovar(*arrs):
-    tensors = [(T.Tensor(a.astype('float32')) if isinstance(a, NP.ndarray) else a).cuda() for a in arrs]
+    tensors = [cuda(bufferpool.as_tensor(a, batch_pool) if isinstance(a, NP.ndarray) else a) for a in arrs]
     vars_ = [T.autograd.Variable(t) for t in tensors]
     return vars_[0] if len(vars_) == 1 else vars_
 
-def adversarially_sample_z(batch_size, nframes, _noise_size, maxlen, embed_g, noisescale, embed_d, real_data, real_len, 
-                                       g_optim, framesize, scale=1e-2):
-    z = tovar(T.randn(batch_size, nframes, _noise_size))
-    z.requires_grad = True
-    fake_data, fake_s, fake_stop_list, fake_len = g(batch_size=batch_size, length=maxlen, c=embed_g, z = z)
-    noise = tovar(T.randn(*fake_data.size()) * noisescale)
-    fake_data += noise
-    
-    cls_g, hidden_states_g, hidden_states_length_g, nframes_g = d(fake_data, fake_len, embed_d)
-    
-    _, hidden_states_d, hidden_states_length_d, nframes_d = d(real_data, real_len, embed_d)
-    dists_d = calc_dists(hidden_states_d, hidden_states_length_d)
-    dists_g = calc_dists(hidden_states_g, hidden_states_length_g)
-    feature_penalty = 0
-    #dists are (object, std) pairs.
-    #penalizing z-scores of gen from real distribution
-    #Note that the model could not do anything to r[1] by optimizing G.
-    for r, f in zip(dists_d, dists_g):
-        feature_penalty += T.pow((r[0] - f[0]), 2).mean() / batch_size
-
-    if g_optim == 'boundary_seeking':
-        target = tovar(T.ones(*(cls_g.size())) * 0.5)   # TODO: add logZ estimate, may be unnecessary
-    else:
-        target = tovar(T.zeros(*(cls_g.size())))            
-    weight = length_mask(cls_g.size(), nframes_g)
-    nframes_max = (fake_len / framesize).data.max()
-    weight_r = length_mask((batch_size, nframes_max), fake_len / framesize)
-    loss = binary_cross_entropy_with_logits_per_sample(cls_g, target, weight=weight) / nframes_g.float()
-
-
-    
-    # Check gradient w.r.t. generated output occasionally
-    grad = T.autograd.grad(loss, z, grad_outputs=T.ones(loss.size()).cuda(), 
-                           create_graph=True, retain_graph=True, only_inputs=True)[0]
-    advers = (grad > 1e-9).type(T.FloatTensor) * scale - (grad < -1e-9).type(T.FloatTensor) * scale
-    advers = advers.data
-
-    z = tovar((z + tovar(advers)).data)
-    return z
-
-def adversarial_movement_d(data, data_len, embed_d, target, weight, d, scale = 1e-3):
-    cls, _, _, nframes = d(data, data_len, embed_d)
-
-    #feature_penalty = [T.pow(r - f,2).mean() for r, f in zip(dists_d, dists_g)]
-    loss = binary_cross_entropy_with_logits_per_sample(cls, target, weight=weight) / nframes.float()
-    # Check gradient w.r.t. generated output occasionally
-    grad = T.autograd.grad(loss, data, grad_outputs=T.ones(loss.size()).cuda(), 
-                           create_graph=True, retain_graph=True, only_inputs=True)[0]
-                           
-    advers = (grad > 0).type(T.FloatTensor) * scale - (grad < 0).type(T.FloatTensor) * scale
-    advers = advers.data
-    return advers
-
-
-def adversarial_movement_g(data, embed_d, target, weight, d, scale = 1e-3):
+def classifier_loss(d, data, data_len, embed_d, target):
+    '''
+    Per-sample classification loss of d, where target holds the target of
+    each row.  Returns the loss together with the logits, the frame weights
+    and the number of frames.
+    '''
     cls, _, _, nframes = d(data, data_len, embed_d)
-
-    #feature_penalty = [T.pow(r - f,2).mean() for r, f in zip(dists_d, dists_g)]
+    target = target.unsqueeze(1).expand_as(cls)
+    weight = length_mask(cls.size(), nframes)
     loss = binary_cross_entropy_with_logits_per_sample(cls, target, weight=weight) / nframes.float()
-    # Check gradient w.r.t. generated output occasionally
-    grad = T.autograd.grad(loss, data, grad_outputs=T.ones(loss.size()).cuda(), 
-                           create_graph=True, retain_graph=True, only_inputs=True)[0]
-                           
-    advers = (grad > 0).type(T.FloatTensor) * scale - (grad < 0).type(T.FloatTensor) * scale
-    advers = advers.data
-    return advers
+    return loss, cls, weight, nframes
+
+def _leaf(v):
+    leaf = v.detach()
+    leaf.requires_grad = v.requires_grad
+    return leaf
+
+def classifier_loss_tbptt(d, x, nframes, embed_d, target, coef, window):
+    '''
+    Truncated-BPTT counterpart of classifier_loss(), starting from the
+    features x returned by d.features().  The recurrent classifier runs in
+    windows of @window frames, and (loss * coef).sum() is back-propagated
+    window by window, so only one window of LSTM activations is alive at a
+    time.
+
+    Back-propagation stops at x and embed_d.  Returns the (detached) loss,
+    logits and frame weights, and a list of (variable, gradient) pairs for
+    x and embed_d that the caller back-propagates further.
+    '''
+    x_leaf = _leaf(x)
+    embed_leaf = _leaf(embed_d)
+    weight = length_mask((x.size()[0], x.size()[1]), nframes)
+    target = target.unsqueeze(1).expand_as(weight)
+    loss = 0
+    cls = []
+    state = None
+    for start in range(0, x.size()[1], window):
+        cls_w, state = d.classify_window(x_leaf, embed_leaf, nframes, start, window, state)
+        end = start + cls_w.size()[1]
+        loss_w = binary_cross_entropy_with_logits_per_sample(
+                cls_w, target[:, start:end], weight=weight[:, start:end]) / nframes.float()
+        if loss_w.requires_grad:
+            (loss_w * coef).sum().backward()
+        loss = loss + loss_w.data
+        cls.append(cls_w.data)
+    grads = [(v, leaf.grad) for v, leaf in [(x, x_leaf), (embed_d, embed_leaf)] if leaf.grad is not None]
+    return T.autograd.Variable(loss), T.autograd.Variable(T.cat(cls, 1)), weight, grads
 
 
 def tonumpy(*vars_):
@@ -184,10 +184,7 @@ def log_one_minus_sigmoid(x):
     return x_sign * y_pos + (1 - x_sign) * y_neg
 
 
-def binary_cross_entropy_with_logits_per_sample(input, target, weight=None):
-    if not target.is_same_size(input):
-        raise ValueError("Target size ({}) must be the same as input size ({})".format(target.size(), input.size()))
-
+def _bce_with_logits(input, target, weight):
     max_val = (-input).clamp(min=0)
     loss = input - input * target + max_val + ((-max_val).exp() + (-input - max_val).exp()).log()
 
@@ -196,6 +193,48 @@ def binary_cross_entropy_with_logits_per_sample(input, target, weight=None):
 
     return loss.sum(1)
 
+# Replaced by a traced graph in compile_models()
+_bce_with_logits_weighted = _bce_with_logits
+
+def binary_cross_entropy_with_logits_per_sample(input, target, weight=None):
+    if not target.is_same_size(input):
+        raise ValueError("Target size ({}) must be the same as input size ({})".format(target.size(), input.size()))
+    if weight is None:
+        return _bce_with_logits(input, target, None)
+    return _bce_with_logits_weighted(input, target, weight)
+
+
+def pad_right(x, length):
+    if x.size()[1] == length:
+        return x
+    return T.cat([x, tovar(T.zeros(x.size()[0], length - x.size()[1]))], 1)
+
+
+def concat_batches(xs, lengths):
+    '''
+    Concatenates batches of audio with possibly different padded lengths
+    into a single batch.
+    '''
+    maxlen = max(x.size()[1] for x in xs)
+    return T.cat([pad_right(x, maxlen) for x in xs], 0), T.cat(lengths, 0)
+
+
+def split_batch(t, sizes):
+    '''
+    Splits (possibly nested lists/tuples of) tensors along the batch
+    dimension into chunks of the given sizes.
+    '''
+    if t is None:
+        return [None] * len(sizes)
+    if isinstance(t, (list, tuple)):
+        return list(zip(*[split_batch(_t, sizes) for _t in t]))
+    chunks = []
+    start = 0
+    for size in sizes:
+        chunks.append(t.narrow(0, start, size))
+        start += size
+    return chunks
+
 
 def advanced_index(t, dim, index):
     return t.transpose(dim, 0)[index].transpose(dim, 0)
@@ -229,28 +268,49 @@ def dynamic_rnn(rnn, seq, length, initial_state):
     return out, state
 
 
-def check_grad(params):
-    for p in params:
-        if p.grad is None:
-            continue
-        g = p.grad.data
-        anynan = (g != g).long().sum()
-        anybig = (g.abs() > 1e+5).long().sum()
-        assert anynan == 0
-        assert anybig == 0
-
-
-def clip_grad(params, clip_norm):
-    if clip_norm == 0:
-        return
-    norm = 0
-    for p in params:
-        if p.grad is not None:
-            _norm = T.norm(p.grad.data)
-            norm += _norm
-            if _norm > clip_norm:
-                p.grad.data /= (_norm / clip_norm)
-    return norm
+def check_and_clip_grad(params, clip_norm, mode):
+    '''
+    Checks and clips the gradients in one pass.  Returns the gradient norm.
+    NaNs and huge gradients are fatal.
+    '''
+    health = gradient.clip_grads(params, clip_norm, mode)
+    assert health.finite
+    assert not health.overflow
+    return health.norm
+
+
+def chunked_conv(conv, xs):
+    '''
+    Applies the Conv1d module @conv to the concatenation of @xs along the
+    channel dimension without building it: the weight is split by input
+    channels and the partial convolutions are summed.
+    '''
+    # Let weight norm compute the weights, as it would in conv(x)
+    for hook in conv._forward_pre_hooks.values():
+        hook(conv, None)
+    out = None
+    start = 0
+    for x in xs:
+        n = x.size()[1]
+        y = F.conv1d(x, conv.weight[:, start:start + n], None, conv.stride, conv.padding, conv.dilation)
+        out = y if out is None else out + y
+        start += n
+    if conv.bias is not None:
+        out = out + conv.bias.view(1, -1, 1)
+    return out
+
+
+def last_channels(xs, n):
+    '''
+    Returns the last @n channels of the concatenation of @xs.
+    '''
+    chunks = []
+    for x in reversed(xs):
+        if n <= 0:
+            break
+        chunks.insert(0, x[:, -n:] if x.size()[1] > n else x)
+        n -= x.size()[1]
+    return chunks[0] if len(chunks) == 1 else T.cat(chunks, 1)
 
 
 class Residual(NN.Module):
@@ -282,6 +342,17 @@ class dense_res_bottleneck(NN.Module):
             act += x[:,-self.outfilters:,:]
         return self.relu(act)
 
+    def forward_chunks(self, xs):
+        '''
+        Same as forward(), with the input given as a list of chunks along
+        the channel dimension instead of their concatenation.
+        '''
+        act = self.relu(chunked_conv(self.conv, xs))
+        act = self.deconv(act)
+        if self.infilters >= self.outfilters:
+            act += last_channels(xs, self.outfilters)
+        return self.relu(act)
+
 
 class dense_res(NN.Module):
     def __init__(self,kernel,infilters,outfilters):
@@ -311,7 +382,7 @@ class Embedder(NN.Module):
         self._char_embed_size = char_embed_size
         self._num_layers = num_layers
 
-        self.embed = NN.DataParallel(NN.Embedding(num_chars, char_embed_size))
+        self.embed = NN.Embedding(num_chars, char_embed_size)
         self.rnn = NN.LSTM(
                 char_embed_size,
                 output_size // 2,
@@ -338,15 +409,23 @@ def fourth_moment(v):
     fourth_var = (((v -v_mean.unsqueeze(0))**4).sum(0))**(1/4)
     return fourth_var
 
-def calc_dists(hidden_states, hidden_state_lengths):
+def layer_stats(h, l):
+    '''
+    Per-sample statistics of each channel of a (batch, channels, time)
+    activation h over its first l frames: the mean, and the L2 and L4
+    deviations from it.  These are all calc_dists() needs from a layer.
+    '''
+    mask = length_mask((h.size()[0], h.size()[2]), l)
+    m = h.sum(2) / l.unsqueeze(1).float()
+    s = (((h - m.unsqueeze(2) * mask.unsqueeze(1).float()) ** 2).sum(2) ** (1./2.) ) / l.unsqueeze(1).float()
+    f = (((h - m.unsqueeze(2) * mask.unsqueeze(1).float()) ** 4).sum(2) ** (1./4.) ) / l.unsqueeze(1).float()
+    return m, s, f
+
+def calc_dists(stats):
     means_d = []
     stds_d = []
     fourth_d = []
-    for h, l in zip(hidden_states, hidden_state_lengths):
-        mask = length_mask((h.size()[0], h.size()[2]), l)
-        m = h.sum(2) / l.unsqueeze(1).float()
-        s = (((h - m.unsqueeze(2) * mask.unsqueeze(1).float()) ** 2).sum(2) ** (1./2.) ) / l.unsqueeze(1).float()
-        f = (((h - m.unsqueeze(2) * mask.unsqueeze(1).float()) ** 4).sum(2) ** (1./4.) ) / l.unsqueeze(1).float()
+    for m, s, f in stats:
         means_d.append((m.mean(0),m.std(0)))
         means_d.append((s.mean(0),s.std(0)))
         means_d.append((f.mean(0),f.std(0)))
@@ -365,9 +444,15 @@ class Generator(NN.Module):
                  noise_size=100,
                  state_size=1024,
                  num_layers=1,
-                 struct = [[17, 8, 128, 16],[9, 4, 64, 32],[9, 4, 64, 32],[9, 4, 32, 32]]
+                 struct = [[17, 8, 128, 16],[9, 4, 64, 32],[9, 4, 64, 32],[9, 4, 32, 32]],
+                 tbptt=0,
                  ):
+        '''
+        tbptt: if positive, the recurrent state is detached every @tbptt
+                frames, so that gradients do not flow back further than that.
+        '''
         NN.Module.__init__(self)
+        self.tbptt = tbptt
         self._frame_size = frame_size
         self._noise_size = noise_size
         self._state_size = state_size
@@ -376,38 +461,50 @@ class Generator(NN.Module):
 
         self.rnn = NN.ModuleList()
         self.rnn.append(
-                NN.DataParallel(weight_norm(
+                weight_norm(
                     NN.LSTMCell(frame_size + embed_size + noise_size, state_size), 
-                    ['weight_ih', 'weight_hh', 'bias_hh', 'bias_ih'])))
+                    ['weight_ih', 'weight_hh', 'bias_hh', 'bias_ih']))
         for _ in range(1, num_layers):
             self.rnn.append(
-                    NN.DataParallel(weight_norm(
+                    weight_norm(
                         NN.LSTMCell(state_size, state_size),
-                        ['weight_ih', 'weight_hh', 'bias_hh', 'bias_ih'])))
+                        ['weight_ih', 'weight_hh', 'bias_hh', 'bias_ih']))
         self.dense_res_gen = NN.ModuleList()
         infilters = 1
         for layer in struct:
             kernel, stride, hidden_filters, outfilters = layer[0], layer[1], layer[2], layer[3]
             self.dense_res_gen.append(
-                NN.DataParallel(
                     dense_res_bottleneck(
                         kernel = kernel,
                         stride = stride,
                         infilters = infilters,
                         hidden_filters = hidden_filters,
                         outfilters = outfilters
-                        )))
+                        ))
                     #dense_res(kernel=11, stride = 5, infilters=infilters,outfilters=filters)))
             infilters += outfilters
             
         kernel=3
         self.dense_res_gen.append(
-            NN.DataParallel(
                 weight_norm(NN.Conv1d(infilters, 1, kernel_size=kernel, stride=1, padding=(kernel - 1) // 2),
-                ['weight','bias'])))
+                ['weight','bias']))
         
-        self.proj = NN.DataParallel(weight_norm(NN.Linear(state_size, frame_size), ['weight', 'bias']))
-        self.stopper = NN.DataParallel(weight_norm(NN.Linear(state_size, 1), ['weight', 'bias']))
+        self.proj = weight_norm(NN.Linear(state_size, frame_size), ['weight', 'bias'])
+        self.stopper = weight_norm(NN.Linear(state_size, 1), ['weight', 'bias'])
+
+    def frame_step(self, _x, lstm_h, lstm_c):
+        '''
+        Runs the LSTM stack for one frame.  Returns the generated frame, the
+        stop logit and the new states (tuples with one entry per layer).
+        '''
+        lstm_h = list(lstm_h)
+        lstm_c = list(lstm_c)
+        lstm_h[0], lstm_c[0] = self.rnn[0](_x, (lstm_h[0], lstm_c[0]))
+        for i in range(1, self._num_layers):
+            lstm_h[i], lstm_c[i] = self.rnn[i](lstm_h[i-1], (lstm_h[i], lstm_c[i]))
+        x_t = self.proj(lstm_h[-1]).tanh_()
+        logit_s_t = self.stopper(lstm_h[-1])
+        return x_t, logit_s_t, tuple(lstm_h), tuple(lstm_c)
 
     def forward(self, batch_size=None, length=None, z=None, c=None):
         frame_size = self._frame_size
@@ -425,8 +522,8 @@ class Generator(NN.Module):
         c = c.unsqueeze(1).expand(batch_size, nframes, embed_size)
         z = T.cat([z, c], 2)
 
-        lstm_h = [tovar(T.zeros(batch_size, state_size)) for _ in range(num_layers)]
-        lstm_c = [tovar(T.zeros(batch_size, state_size)) for _ in range(num_layers)]
+        lstm_h = tuple(tovar(T.zeros(batch_size, state_size)) for _ in range(num_layers))
+        lstm_c = tuple(tovar(T.zeros(batch_size, state_size)) for _ in range(num_layers))
         x_t = tovar(T.zeros(batch_size, frame_size))
         generating = T.ones(batch_size).long()
         length = T.zeros(batch_size).long()
@@ -435,19 +532,19 @@ class Generator(NN.Module):
         s_list = []
         stop_list = []
         for t in range(nframes):
+            if self.tbptt > 0 and t > 0 and t % self.tbptt == 0:
+                lstm_h = tuple(h.detach() for h in lstm_h)
+                lstm_c = tuple(_c.detach() for _c in lstm_c)
+                x_t = x_t.detach()
             z_t = z[:, t]
             _x = T.cat([x_t, z_t], 1)
-            lstm_h[0], lstm_c[0] = self.rnn[0](_x, (lstm_h[0], lstm_c[0]))
-            for i in range(1, num_layers):
-                lstm_h[i], lstm_c[i] = self.rnn[i](lstm_h[i-1], (lstm_h[i], lstm_c[i]))
-            x_t = self.proj(lstm_h[-1]).tanh_()
-            logit_s_t = self.stopper(lstm_h[-1])
+            x_t, logit_s_t, lstm_h, lstm_c = self.frame_step(_x, lstm_h, lstm_c)
             s_t = log_sigmoid(logit_s_t)
             s1_t = log_one_minus_sigmoid(logit_s_t)
 
             logp_t = T.cat([s1_t, s_t], 1)
             p_t = logp_t.exp()
-            stop_t = p_t.multinomial()
+            stop_t = p_t.multinomial(1)
             length += generating
 
             x_list.append(x_t)
@@ -461,11 +558,14 @@ class Generator(NN.Module):
 
         x = T.cat(x_list, 1)
         s = T.stack(s_list, 1)
-        x = x.unsqueeze(1)
-        for layer in self.dense_res_gen:
-            x_next = layer(x)
-            x = T.cat([x, x_next],1)
-        return x_next.squeeze(1), s, stop_list, tovar(length * frame_size)
+        # Every layer sees the outputs of all layers before it.  They are
+        # kept as separate chunks rather than concatenated, so that each
+        # output is stored once.
+        xs = [x.unsqueeze(1)]
+        for layer in self.dense_res_gen[:-1]:
+            xs.append(layer.forward_chunks(xs))
+        x = chunked_conv(self.dense_res_gen[-1], xs)
+        return x.squeeze(1), s, stop_list, tovar(length * frame_size)
 
 
 class Discriminator(NN.Module):
@@ -473,12 +573,20 @@ class Discriminator(NN.Module):
                  state_size=1024,
                  embed_size=200,
                  num_layers=1,
-                 cnn_struct = [[7, 2, 16], [7, 2, 32], [7, 2, 64], [7, 2, 128], [7, 2, 256], [7, 2, 512]]):
+                 cnn_struct = [[7, 2, 16], [7, 2, 32], [7, 2, 64], [7, 2, 128], [7, 2, 256], [7, 2, 512]],
+                 checkpoint_activations=False):
+        '''
+        checkpoint_activations: do not keep the activations of the conv stack
+                and of the recurrent classifier for backward, but recompute
+                them there (one extra forward pass) to save memory.  Needs
+                torch.utils.checkpoint and is ignored without it.
+        '''
         NN.Module.__init__(self)
         self._state_size = state_size
         self._embed_size = embed_size
         self._num_layers = num_layers
         self._cnn_struct = cnn_struct
+        self.checkpoint_activations = checkpoint_activations
         
         self.cnn = NN.ModuleList()
         self.cnn_struct = cnn_struct
@@ -489,216 +597,454 @@ class Discriminator(NN.Module):
             conv = weight_norm(
                 NN.Conv1d(infilters, outfilters, kernel, stride=stride, padding=(kernel - 1) // 2),
                 ['weight','bias'])
-            self.cnn.append(NN.DataParallel(conv))
+            self.cnn.append(conv)
 
             infilters = outfilters
         frame_size = outfilters
         self.frame_size = frame_size
         self._frame_size = frame_size
+        # number of audio samples per frame of the recurrent classifier
+        self.frame_stride = int(NP.prod([layer[1] for layer in cnn_struct]))
         self.rnn = NN.LSTM(
                 frame_size + embed_size,
                 state_size // 2,
                 num_layers,
                 bidirectional=True,
                 )
-        self.residual_net = NN.DataParallel(NN.Sequential(
+        self.residual_net = NN.Sequential(
                 Residual(state_size),
                 Residual(state_size),
-            ))
-        self.classifier = NN.DataParallel(NN.Sequential(
+            )
+        self.classifier = NN.Sequential(
                 weight_norm(NN.Linear(state_size, state_size // 2),['weight','bias']),
                 NN.LeakyReLU(),
                 weight_norm(NN.Linear(state_size // 2, 1),['weight','bias'])
-                ))
+                )
 
-    def forward(self, x, length, c, percent_used = 0.1):
-        frame_size = self._frame_size
+    def _run(self, fn, *args):
+        if (self.checkpoint_activations and recompute is not None and T.is_grad_enabled() and
+                any(getattr(a, 'requires_grad', False) for a in args)):
+            return recompute(fn, *args)
+        return fn(*args)
+
+    def _conv_layers(self, cnn_output, lengths, with_stats):
+        batch_size = cnn_output.size()[0]
+        stats = []
+        for cnn_layer, nframes in zip(self.cnn, lengths):
+            cnn_output = F.leaky_relu(cnn_layer(cnn_output))
+            cnn_output = cnn_output * length_mask((batch_size, cnn_output.size()[2]), nframes).unsqueeze(1)
+            if with_stats:
+                stats.extend(layer_stats(cnn_output, nframes))
+        return cnn_output, stats
+
+    def _conv_stack(self, cnn_output, *lengths):
+        return self._conv_layers(cnn_output, lengths, False)[0]
+
+    def _conv_stack_stats(self, cnn_output, *lengths):
+        cnn_output, stats = self._conv_layers(cnn_output, lengths, True)
+        return tuple([cnn_output] + stats)
+
+    def _classify(self, x, c, nframes, h0=None, c0=None):
         state_size = self._state_size
         num_layers = self._num_layers
         embed_size = self._embed_size
-        batch_size, maxlen = x.size()
-
-        xold = x
+        batch_size, max_nframes, _ = x.size()
 
-        initial_state = (
-                tovar(T.zeros(num_layers * 2, batch_size, state_size // 2)),
-                tovar(T.zeros(num_layers * 2, batch_size, state_size // 2)),
-                )
-        cnn_outputs = []
-        cnn_output_lengths = []
-        cnn_output = xold.unsqueeze(1)
-        nframes = length
-        for cnn_layer, (_, stride, _) in zip(self.cnn, self.cnn_struct):
-            cnn_output = F.leaky_relu(cnn_layer(cnn_output))
-            nframes = (nframes + stride - 1) / stride
-            cnn_output = cnn_output * length_mask((batch_size, cnn_output.size()[2]), nframes).unsqueeze(1)
-            cnn_outputs.append(cnn_output)
-            cnn_output_lengths.append(nframes)
-        x = cnn_output
-        x = x.permute(0, 2, 1)
-        #x = x.view(32, nframes_max, frame_size)
-        max_nframes = x.size()[1]
+        if h0 is None:
+            h0 = tovar(T.zeros(num_layers * 2, batch_size, state_size // 2))
+            c0 = tovar(T.zeros(num_layers * 2, batch_size, state_size // 2))
         c = c.unsqueeze(1).expand(batch_size, max_nframes, embed_size)
         x2 = T.cat([x, c], 2).permute(1,0,2)
-        lstm_out, (_, _) = dynamic_rnn(self.rnn, x2, nframes, initial_state)
+        lstm_out, (h, c) = dynamic_rnn(self.rnn, x2, nframes, (h0, c0))
         lstm_out = lstm_out.permute(1, 0, 2)
         max_nframes = lstm_out.size()[1]
 
         conv_out = lstm_out.view(batch_size * max_nframes, state_size)
-        res_out = self.residual_net(conv_out)
-        classifier_out = self.classifier(res_out).view(batch_size, max_nframes)
-        
-        return classifier_out, cnn_outputs, cnn_output_lengths, nframes
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--critic_iter', default=100, type=int)
-parser.add_argument('--rnng_layers', type=int, default=1)
-parser.add_argument('--rnnd_layers', type=int, default=1)
-parser.add_argument('--framesize', type=int, default=200, help='# of amplitudes to generate at a time for RNN')
-parser.add_argument('--noisesize', type=int, default=100, help='noise vector size')
-parser.add_argument('--gstatesize', type=int, default=1024, help='RNN state size')
-parser.add_argument('--dstatesize', type=int, default=1024, help='RNN state size')
-parser.add_argument('--batchsize', type=int, default=32)
-parser.add_argument('--dgradclip', type=float, default=1)
-parser.add_argument('--ggradclip', type=float, default=0.1)
-parser.add_argument('--dlr', type=float, default=1e-4)
-parser.add_argument('--glr', type=float, default=1e-4)
-parser.add_argument('--modelname', type=str, default = '')
-parser.add_argument('--modelnamesave', type=str, default='')
-parser.add_argument('--modelnameload', type=str, default='')
-parser.add_argument('--just_run', type=str, default='')
-parser.add_argument('--loaditerations', type=int, default=0)
-parser.add_argument('--gencatchup', type=int, default=1)
-parser.add_argument('--logdir', type=str, default='.', help='log directory')
-parser.add_argument('--dataset', type=str, default='dataset.h5')
-parser.add_argument('--embedsize', type=int, default=100)
-parser.add_argument('--minwordlen', type=int, default=1)
-parser.add_argument('--maxlen', type=int, default=40000, help='maximum sample length (0 for unlimited)')
-parser.add_argument('--noisescale', type=float, default=0.01)
-parser.add_argument('--g_optim', default = 'boundary_seeking')
-parser.add_argument('--require_acc', type=float, default=0.5)
-
-args = parser.parse_args()
-args.conditional = True
-if args.just_run not in ['', 'gen', 'dis']:
-    print('just run should be empty string, gen, or dis. Other values not accepted')
-    sys.exit(0)
-lambda_fp = 1
-if len(args.modelname) > 0:
-    modelnamesave = args.modelname
-    modelnameload = None
-else:
-    modelnamesave = args.modelnamesave
-    modelnameload = args.modelnameload
-
-print modelnamesave
-print args
-
-batch_size = args.batchsize
-
-dataset_h5, maxlen, dataloader, dataloader_val, keys_train, keys_val = \
-        dataset.dataloader(batch_size, args, maxlen=args.maxlen, frame_size=args.framesize)
-maxcharlen_train = max(len(k) for k in keys_train)
-
-def logdirs(logdir, modelnamesave):
-    logdir = (
-            logdir + '/%s-%s' % 
-            (modelnamesave, datetime.datetime.strftime(
-                datetime.datetime.now(), '%Y%m%d%H%M%S')
-                )
-            )
-    if not os.path.exists(logdir):
-        os.mkdir(logdir)
-    elif not os.path.isdir(logdir):
-        raise IOError('%s is not a directory' % logdir)
-    return logdir
-log_train_d = logdirs(args.logdir, modelnamesave)
-png_file = '%s/temp.png' % log_train_d
-wav_file = '%s/temp.wav' % log_train_d
-
-
-g = Generator(
-        frame_size=args.framesize,
-        noise_size=args.noisesize,
-        state_size=args.gstatesize,
-        embed_size=args.embedsize,
-        num_layers=args.rnng_layers,
-        ).cuda()
-nframes = div_roundup(maxlen, args.framesize)
-z_fixed = tovar(RNG.randn(batch_size, nframes, args.noisesize))
-
-e_g = Embedder(args.embedsize).cuda()
-e_d = Embedder(args.embedsize).cuda()
-
-d = Discriminator(
-        state_size=args.dstatesize,
-        embed_size=args.embedsize,
-        num_layers=args.rnnd_layers,
-        ).cuda()
-
-def add_waveform_summary(writer, word, sample, gen_iter, tag='plot'):
-    PL.plot(sample)
-    PL.savefig(png_file)
-    PL.close()
-    with open(png_file, 'rb') as f:
-        imgbuf = f.read()
-    img = Image.open(png_file)
-    summary = TF.Summary.Image(
-            height=img.height,
-            width=img.width,
-            colorspace=3,
-            encoded_image_string=imgbuf
-            )
-    summary = TF.Summary.Value(tag='%s/%s' % (tag, word), image=summary)
-    writer.add_summary(TF.Summary(value=[summary]), gen_iter)
-
-def add_audio_summary(writer, word, sample, length, gen_iter, tag='audio'):
-    librosa.output.write_wav(wav_file, sample, sr=8000)
-    with open(wav_file, 'rb') as f:
-        wavbuf = f.read()
-    summary = TF.Summary.Audio(
-            sample_rate=8000,
-            num_channels=1,
-            length_frames=length,
-            encoded_audio_string=wavbuf,
-            content_type='audio/wav'
-            )
-    summary = TF.Summary.Value(tag='%s/%s' % (tag, word), audio=summary)
-    d_train_writer.add_summary(TF.Summary(value=[summary]), gen_iter)
-
-d_train_writer = TF.summary.FileWriter(log_train_d)
-
-# Add real waveforms
-_, _, samples, lengths, cseq, cseq_fixed, clen_fixed = dataloader_val.next()
-for i in range(batch_size):
-    add_waveform_summary(d_train_writer, cseq[i], samples[i, :lengths[i]], 0, 'real_plot')
-    add_audio_summary(d_train_writer, cseq[i], samples[i, :lengths[i]], lengths[i], 0, 'real_audio')
-
-cseq_fixed = NP.array(cseq_fixed)
-clen_fixed = NP.array(clen_fixed)
-cseq_fixed, clen_fixed = tovar(cseq_fixed, clen_fixed)
-cseq_fixed = cseq_fixed.long()
-clen_fixed = clen_fixed.long()
-
-gen_iter = 0
-dis_iter = 0
-epoch = 1
-l = 10
-alpha = 0.1
-baseline = None
-
-param_g = list(g.parameters()) + list(e_g.parameters())
-param_d = list(d.parameters()) + list(e_d.parameters())
-
-opt_g = T.optim.RMSprop(param_g, lr=args.glr)
-opt_d = T.optim.RMSprop(param_d, lr=args.dlr)
+        return self.head(conv_out).view(batch_size, max_nframes).float(), h, c
+
+    def head(self, x):
+        '''
+        Per-frame logits from the (frames, state_size) LSTM outputs.
+        '''
+        return self.classifier(self.residual_net(x))
+
+    def classify_window(self, x, c, nframes, start, window, state=None):
+        '''
+        Runs the recurrent classifier on frames [start, start + window) of
+        the features x returned by features().  The forward direction of the
+        LSTM continues from @state, detached, while the reverse direction
+        starts afresh in every window.
+
+        Returns the logits of the window, padded to its width, and the state
+        to pass to the next window.
+        '''
+        x = x[:, start:start + window]
+        width = x.size()[1]
+        # Samples which already ended still go through with a single frame,
+        # which the caller masks out.
+        nframes = (nframes - start).clamp(1, width)
+        if state is None:
+            h0 = c0 = None
+        else:
+            forward_only = tovar(T.Tensor([1, 0] * self._num_layers)).view(-1, 1, 1)
+            h0 = state[0].detach() * forward_only
+            c0 = state[1].detach() * forward_only
+        logits, h, c = self._run(self._classify, x, c, nframes, h0, c0)
+        return pad_right(logits, width), (h, c)
+
+    def features(self, x, length, stats=False):
+        '''
+        Runs the conv stack.  Returns the (batch, frames, channels) input of
+        the recurrent classifier, the per-sample statistics of every conv
+        layer (see layer_stats(); None unless @stats) with the lengths of the
+        layers, and the number of frames.
+        '''
+        nframes = length
+        cnn_output_lengths = []
+        for _, stride, _ in self.cnn_struct:
+            nframes = (nframes + stride - 1) / stride
+            cnn_output_lengths.append(nframes)
+
+        x = x.unsqueeze(1)
+        if (self.checkpoint_activations and recompute is not None and T.is_grad_enabled() and
+                not x.requires_grad):
+            # Gradients only reach the parameters of a recomputed segment
+            # if one of its inputs requires them.
+            x = x.detach()
+            x.requires_grad = any(p.requires_grad for p in self.cnn.parameters())
+        if stats:
+            outputs = self._run(self._conv_stack_stats, x, *cnn_output_lengths)
+            cnn_output = outputs[0]
+            cnn_stats = [tuple(outputs[i:i + 3]) for i in range(1, len(outputs), 3)]
+        else:
+            cnn_output = self._run(self._conv_stack, x, *cnn_output_lengths)
+            cnn_stats = None
+
+        return cnn_output.permute(0, 2, 1), cnn_stats, cnn_output_lengths, nframes
+
+    def forward(self, x, length, c, percent_used = 0.1, stats=False):
+        '''
+        Returns the per-frame logits, the per-sample statistics of every conv
+        layer (see layer_stats(); None unless @stats) with the lengths of the
+        layers, and the number of frames.
+        '''
+        x, cnn_stats, cnn_output_lengths, nframes = self.features(x, length, stats)
+        classifier_out, _, _ = self._run(self._classify, x, c, nframes)
+
+        return classifier_out, cnn_stats, cnn_output_lengths, nframes
+
+    def forward_split(self, xs, lengths, cs, stats=False):
+        '''
+        Runs several batches through a single forward pass, and returns the
+        outputs of forward() for each of them.
+        '''
+        x, length = concat_batches(xs, lengths)
+        outputs = self.forward(x, length, T.cat(cs, 0), stats=stats)
+        return split_batch(outputs, [_x.size()[0] for _x in xs])
+
+def compile_models(g=None, d=None, batch_size=8):
+    '''
+    Replaces the frame step of @g, the per-frame head of @d and the
+    classification loss by traced graphs, falling back to eager execution
+    for whatever cannot be traced (see compiled.py).  Call after moving the
+    models to their device.
+    '''
+    global _bce_with_logits_weighted
+    nframes = 10
+    logits = tovar(T.randn(batch_size, nframes))
+    target = tovar(T.rand(batch_size, nframes))
+    weight = length_mask((batch_size, nframes), tovar(RNG.randint(1, nframes + 1, batch_size)).long())
+    _bce_with_logits_weighted = compiled.compile_fn(_bce_with_logits, (logits, target, weight), 'loss')
+
+    if g is not None:
+        state = tuple(tovar(T.zeros(batch_size, g._state_size)) for _ in range(g._num_layers))
+        _x = tovar(T.randn(batch_size, g._frame_size + g._noise_size + g._embed_size))
+        compiled.compile_method(g, 'frame_step', (_x, state, state))
+    if d is not None:
+        compiled.compile_method(d, 'head', (tovar(T.randn(batch_size * nframes, d._state_size)),))
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--critic_iter', default=100, type=int)
+    parser.add_argument('--rnng_layers', type=int, default=1)
+    parser.add_argument('--rnnd_layers', type=int, default=1)
+    parser.add_argument('--framesize', type=int, default=200, help='# of amplitudes to generate at a time for RNN')
+    parser.add_argument('--noisesize', type=int, default=100, help='noise vector size')
+    parser.add_argument('--gstatesize', type=int, default=1024, help='RNN state size')
+    parser.add_argument('--dstatesize', type=int, default=1024, help='RNN state size')
+    parser.add_argument('--d_checkpoint', action='store_true',
+                        help='recompute the activations of D in backward instead of keeping them')
+    parser.add_argument('--batchsize', type=int, default=32)
+    parser.add_argument('--accum_d', type=int, default=1, help='# of micro-batches of --batchsize per critic step')
+    parser.add_argument('--accum_g', type=int, default=1, help='# of micro-batches of --batchsize per generator step')
+    parser.add_argument('--dgradclip', type=float, default=1)
+    parser.add_argument('--ggradclip', type=float, default=0.1)
+    parser.add_argument('--gradclip_mode', default='tensor', choices=['tensor', 'global'],
+                        help='clip each gradient tensor on its own, or all gradients by their global norm')
+    parser.add_argument('--dlr', type=float, default=1e-4)
+    parser.add_argument('--glr', type=float, default=1e-4)
+    parser.add_argument('--modelname', type=str, default = '')
+    parser.add_argument('--modelnamesave', type=str, default='')
+    parser.add_argument('--modelnameload', type=str, default='')
+    parser.add_argument('--just_run', type=str, default='')
+    parser.add_argument('--loaditerations', type=int, default=0, help='checkpoint to resume from (0 for the latest)')
+    parser.add_argument('--checkpoint_every', type=int, default=500, help='# of generator iterations between checkpoints')
+    parser.add_argument('--keep_checkpoints', type=int, default=5, help='# of last checkpoints to keep (0 to keep all)')
+    parser.add_argument('--eval_batches', type=int, default=4,
+                        help='# of validation batches in the fixed evaluation set (0 to disable evaluation)')
+    parser.add_argument('--eval_interval', type=float, default=30, help='seconds between checks for a new checkpoint to evaluate')
+    parser.add_argument('--val_every', type=int, default=500, help='# of generator iterations between validation passes (0 to disable)')
+    parser.add_argument('--val_batches', type=int, default=16, help='# of loader batches in the fixed validation set')
+    parser.add_argument('--val_batchsize', type=int, default=0, help='validation batch size (0 for 4 times the training batch size)')
+    parser.add_argument('--val_buckets', type=lambda s: [int(x) for x in s.split(',')], default=[3, 6, 9],
+                        help='upper bounds of the word length buckets for validation')
+    parser.add_argument('--gencatchup', type=int, default=1)
+    parser.add_argument('--logdir', type=str, default='.', help='log directory')
+    parser.add_argument('--dataset', type=str, default='dataset.h5')
+    parser.add_argument('--embedsize', type=int, default=100)
+    parser.add_argument('--minwordlen', type=int, default=1)
+    parser.add_argument('--normalize', default='peak', choices=dataset.NORMALIZATIONS,
+                        help='per-sample gain: peak or RMS of each sample, RMS of each speaker, or none')
+    parser.add_argument('--normalize_rms', type=float, default=0.1,
+                        help='target RMS amplitude of --normalize rms and speaker')
+    parser.add_argument('--word_sampling', default='word', choices=dataset.WordSampler.MODES,
+                        help='draw words uniformly, samples uniformly, or words by temperature-smoothed frequency')
+    parser.add_argument('--word_temperature', type=float, default=2.,
+                        help='temperature of --word_sampling smoothed (1 is the corpus frequency)')
+    parser.add_argument('--maxlen', type=int, default=40000, help='maximum sample length (0 for unlimited)')
+    parser.add_argument('--tbptt', type=int, default=0,
+                        help='truncate back-propagation through the RNNs of G and D to windows of this many samples (0 to disable)')
+    parser.add_argument('--noisescale', type=float, default=0.01)
+    parser.add_argument('--g_optim', default = 'boundary_seeking')
+    parser.add_argument('--require_acc', type=float, default=0.5)
+    parser.add_argument('--advers_d_every', type=int, default=2, help='perturb D inputs every this many critic iterations (0 to disable)')
+    parser.add_argument('--advers_d_steps', type=int, default=1)
+    parser.add_argument('--advers_d_budget', type=float, default=1e-3)
+    parser.add_argument('--advers_z_every', type=int, default=1, help='perturb G noise every this many generator iterations (0 to disable)')
+    parser.add_argument('--advers_z_steps', type=int, default=1)
+    parser.add_argument('--advers_z_budget', type=float, default=1e-2)
+    parser.add_argument('--profile_every', type=int, default=0, help='# of generator iterations between profile reports (0 to disable)')
+    parser.add_argument('--profile_sync', action='store_true', help='synchronize CUDA before reading the clock when profiling')
+    parser.add_argument('--cpu', action='store_true', help='run on CPU even if CUDA is available')
+    parser.add_argument('--threads', type=int, default=0, help='# of intra-op threads per process (0 for the default)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed (required to be the same on all ranks)')
+    parser.add_argument('--world_size', type=int, default=int(os.environ.get('WORLD_SIZE', 1)),
+                        help='# of data-parallel processes; --batchsize is split among them')
+    parser.add_argument('--rank', type=int, default=int(os.environ.get('RANK', 0)))
+    parser.add_argument('--dist_url', type=str, default='env://')
+    parser.add_argument('--dist_backend', type=str, default='gloo')
+    parser.add_argument('--compile', action='store_true',
+                        help='trace the generator frame step, the discriminator head and the loss into graphs')
+    parser.add_argument('--pin_memory', action='store_true',
+                        help='keep the training batches in page-locked memory for faster GPU transfers')
+
+    args = parser.parse_args()
+    args.conditional = True
+    # The generator step uses Variable.reinforce(), which PyTorch removed
+    # before it added torch.jit.trace() and torch.utils.checkpoint.
+    if args.compile and not (compiled.available() and hasattr(T.autograd.Variable, 'reinforce')):
+        parser.error('--compile needs torch.jit.trace() and Variable.reinforce() in the same PyTorch version; '
+                     'use benchmark.py --compile instead')
+    if args.d_checkpoint and not (recompute is not None and hasattr(T.autograd.Variable, 'reinforce')):
+        parser.error('--d_checkpoint needs torch.utils.checkpoint and Variable.reinforce() in the same PyTorch '
+                     'version; use benchmark.py --only discriminator_train_checkpoint instead')
+    if args.cpu:
+        use_cuda = False
+    if args.just_run not in ['', 'gen', 'dis']:
+        print('just run should be empty string, gen, or dis. Other values not accepted')
+        sys.exit(0)
+    lambda_fp = 1
+    if len(args.modelname) > 0:
+        modelnamesave = args.modelname
+        modelnameload = None
+    else:
+        modelnamesave = args.modelnamesave
+        modelnameload = args.modelnameload
+
+    print modelnamesave
+    print args
+
+    if args.threads > 0:
+        T.set_num_threads(args.threads)
+    if args.world_size > 1:
+        if args.batchsize % args.world_size != 0:
+            raise ValueError('--batchsize must be divisible by --world_size')
+        distributed.init(args.dist_backend, args.dist_url, args.world_size, args.rank)
+        if use_cuda:
+            # One GPU per rank, round-robin within a machine
+            T.cuda.set_device(args.rank % T.cuda.device_count())
+    is_chief = args.rank == 0
+    # All ranks must agree on the train/validation split
+    seed = args.seed if args.seed is not None else (0 if args.world_size > 1 else None)
+    if seed is not None:
+        RNG.seed(seed)
+
+    batch_size = args.batchsize // args.world_size
+    batch_pool = bufferpool.BufferPool(pin=args.pin_memory and use_cuda)
+
+    dataset_h5, maxlen, dataloader, dataloader_val, keys_train, keys_val = \
+            dataset.dataloader(batch_size, args, maxlen=args.maxlen, frame_size=args.framesize, pool=batch_pool)
+    maxcharlen_train = keys_train.seqs.shape[1]
+    # Words to generate from, refilled in place by every draw
+    words_g = dataset.WordBatch(batch_size, maxlen, maxcharlen_train)
+    if seed is not None:
+        # ...but draw different batches
+        RNG.seed(seed + 1 + args.rank)
+        T.manual_seed(seed + args.rank)
+
+    def logdirs(logdir, modelnamesave):
+        logdir = (
+                logdir + '/%s-%s' % 
+                (modelnamesave, datetime.datetime.strftime(
+                    datetime.datetime.now(), '%Y%m%d%H%M%S')
+                    )
+                )
+        if not os.path.exists(logdir):
+            os.mkdir(logdir)
+        elif not os.path.isdir(logdir):
+            raise IOError('%s is not a directory' % logdir)
+        return logdir
+    if is_chief:
+        log_train_d = logdirs(args.logdir, modelnamesave)
+        png_file = '%s/temp.png' % log_train_d
+        wav_file = '%s/temp.wav' % log_train_d
+
+
+    def build_models():
+        return {
+                'gen': cuda(Generator(
+                    frame_size=args.framesize,
+                    noise_size=args.noisesize,
+                    state_size=args.gstatesize,
+                    embed_size=args.embedsize,
+                    num_layers=args.rnng_layers,
+                    tbptt=div_roundup(args.tbptt, args.framesize),
+                    )),
+                'dis': cuda(Discriminator(
+                    state_size=args.dstatesize,
+                    embed_size=args.embedsize,
+                    num_layers=args.rnnd_layers,
+                    checkpoint_activations=args.d_checkpoint,
+                    )),
+                'eg': cuda(Embedder(args.embedsize)),
+                'ed': cuda(Embedder(args.embedsize)),
+                }
+    models = build_models()
+    g, d, e_g, e_d = models['gen'], models['dis'], models['eg'], models['ed']
+    # Windows shorter than a frame would silently disable truncation, so
+    # they are rounded up to whole frames.
+    d_window = div_roundup(args.tbptt, d.frame_stride)
+    if args.tbptt % args.framesize != 0 or args.tbptt % d.frame_stride != 0:
+        print 'Rounded --tbptt %d up to %d samples for G and %d samples for D' % (
+                args.tbptt, div_roundup(args.tbptt, args.framesize) * args.framesize, d_window * d.frame_stride)
+
+    def add_waveform_summary(writer, word, sample, gen_iter, tag='plot'):
+        PL.plot(sample)
+        PL.savefig(png_file)
+        PL.close()
+        with open(png_file, 'rb') as f:
+            imgbuf = f.read()
+        img = Image.open(png_file)
+        summary = TF.Summary.Image(
+                height=img.height,
+                width=img.width,
+                colorspace=3,
+                encoded_image_string=imgbuf
+                )
+        summary = TF.Summary.Value(tag='%s/%s' % (tag, word), image=summary)
+        writer.add_summary(TF.Summary(value=[summary]), gen_iter)
+
+    def add_audio_summary(writer, word, sample, length, gen_iter, tag='audio'):
+        librosa.output.write_wav(wav_file, sample, sr=8000)
+        with open(wav_file, 'rb') as f:
+            wavbuf = f.read()
+        summary = TF.Summary.Audio(
+                sample_rate=8000,
+                num_channels=1,
+                length_frames=length,
+                encoded_audio_string=wavbuf,
+                content_type='audio/wav'
+                )
+        summary = TF.Summary.Value(tag='%s/%s' % (tag, word), audio=summary)
+        d_train_writer.add_summary(TF.Summary(value=[summary]), gen_iter)
+
+    def add_profile_summary(writer, gen_iter):
+        values = []
+        for name, stats in sorted(Timer.report().items()):
+            for k in ['mean', 'p50', 'p95', 'p99']:
+                values.append(TF.Summary.Value(tag='profile/%s/%s' % (name, k), simple_value=stats[k]))
+        writer.add_summary(TF.Summary(value=values), gen_iter)
+
+    d_train_writer = TF.summary.FileWriter(log_train_d) if is_chief else distributed.NullWriter()
+    if args.profile_sync and use_cuda:
+        Timer.sync = T.cuda.synchronize
+
+    # Add real waveforms
+    _, _, samples, lengths, cseq, cseq_fixed, clen_fixed = dataloader_val.next()
+    # Copied, as the loader refills its batch arrays
+    samples, lengths, cseq, cseq_fixed, clen_fixed = [
+            a.copy() for a in (samples, lengths, cseq, cseq_fixed, clen_fixed)]
+    if is_chief:
+        for i in range(batch_size):
+            add_waveform_summary(d_train_writer, cseq[i], samples[i, :lengths[i]], 0, 'real_plot')
+            add_audio_summary(d_train_writer, cseq[i], samples[i, :lengths[i]], lengths[i], 0, 'real_audio')
+
+    if is_chief and args.eval_batches > 0:
+        evalset = evaluation.EvalSet.from_loader(
+                (samples, lengths, cseq, cseq_fixed, clen_fixed), dataloader_val, args.eval_batches,
+                div_roundup(maxlen, args.framesize), args.noisesize)
+        evaluator = evaluation.Evaluator(
+                modelnamesave, build_models, evalset, d_train_writer, interval=args.eval_interval)
+        evaluator.start()
+
+    # Samples generated for the fixed words are plotted on this thread, as
+    # pyplot is not thread-safe.
+    nframes = div_roundup(maxlen, args.framesize)
+    like = next(g.parameters()).data
+    z_fixed = evaluation.to_variable(RNG.randn(batch_size, nframes, args.noisesize), like)
+    cseq_fixed = evaluation.to_variable(cseq_fixed, like, NP.int64)
+    clen_fixed = evaluation.to_variable(clen_fixed, like, NP.int64)
+
+    if is_chief and args.val_every > 0:
+        valset = validation.ValidationSet.from_loader(
+                dataloader_val, args.val_batches, args.val_batchsize or 4 * batch_size, args.framesize)
+
+    gen_iter = 0
+    dis_iter = 0
+    epoch = 1
+    l = 10
+    alpha = 0.1
+    baseline = None
+
+    param_g = list(g.parameters()) + list(e_g.parameters())
+    param_d = list(d.parameters()) + list(e_d.parameters())
+
+    opt_g = T.optim.RMSprop(param_g, lr=args.glr)
+    opt_d = T.optim.RMSprop(param_d, lr=args.dlr)
+
+    perturb_d = Perturbation('advers_d', args.advers_d_every, args.advers_d_steps, args.advers_d_budget)
+    perturb_z = Perturbation('advers_z', args.advers_z_every, args.advers_z_steps, args.advers_z_budget, threshold=1e-9)
+
+    checkpoint_modules = {'dis': d, 'gen': g, 'eg': e_g, 'ed': e_d}
+    checkpoint_optimizers = {'opt_g': opt_g, 'opt_d': opt_d}
+    checkpointer = checkpoint.Checkpointer(modelnamesave, keep=args.keep_checkpoints)
+
     if modelnameload:
-        if len(modelnameload) > 0:
-            d = T.load('%s-dis-%05d' % (modelnameload, args.loaditerations))
-            g = T.load('%s-gen-%05d' % (modelnameload, args.loaditerations))
-            e_g = T.load('%s-eg-%05d' % (modelnameload, args.loaditerations))
-            e_d = T.load('%s-ed-%05d' % (modelnameload, args.loaditerations))
+        if args.loaditerations == 0:
+            args.loaditerations, ckpt_path = checkpoint.latest_checkpoint(modelnameload)
+            if ckpt_path is None:
+                raise IOError('no checkpoint found for %s' % modelnameload)
+        else:
+            ckpt_path = checkpoint.checkpoint_path(modelnameload, args.loaditerations)
+        # Load in place so that opt_g and opt_d stay bound to the parameters
+        ckpt = checkpoint.load_checkpoint(ckpt_path, checkpoint_modules, checkpoint_optimizers)
+        dis_iter = ckpt['dis_iter']
+        baseline = ckpt['baseline']
+        print 'Resumed from %s' % ckpt_path
+    if args.world_size > 1:
+        distributed.broadcast_parameters([g, d, e_g, e_d])
+    if args.compile:
+        compile_models(g, d, batch_size)
 
     while True:
         _epoch = epoch
@@ -709,85 +1055,106 @@ if __name__ == '__main__':
             p.requires_grad = True
         for j in range(args.critic_iter):
             dis_iter += 1
-            with Timer.new('load', print_=False):
-                gc.collect()
-                epoch, batch_id, real_data, real_len, _, cs, cl = dataloader.next()
-                _, cs2, cl2, _, _ = dataset.pick_words(
-                        batch_size, maxlen, dataset_h5, keys_train, maxcharlen_train, args, skip_samples=True)
-                #last_real_raw = [real_data, real_len]
-            with Timer.new('train_d', print_=False):
-                cs = tovar(cs).long()
-                cl = tovar(cl).long()
-                embed_d = e_d(cs, cl)
-                real_len = tovar(real_len).long()
-                if dis_iter % 2 == 0:
-                    noise = tovar(RNG.randn(*real_data.shape) * args.noisescale)
-                    real_data = tovar(real_data) + noise
-                    cls_d, hidden_states_d, hidden_states_length_d, nframes_d = d(real_data, real_len, embed_d)
-                    target = tovar(T.ones(*(cls_d.size())) * 0.9)
-                    weight = length_mask(cls_d.size(), nframes_d)
-                else:
-                    real_data = tovar(real_data)
-                    real_data.requires_grad = True
-                    cls_d, hidden_states_d, hidden_states_length_d, nframes_d = d(real_data, real_len, embed_d)
-                    target = tovar(T.ones(*(cls_d.size())) * 0.9)
-                    weight = length_mask(cls_d.size(), nframes_d)
-                    advers = adversarial_movement_d(real_data, real_len, embed_d, target, weight, d)
-                    real_data = tovar((real_data + tovar(advers)).data)
-
-                #real_data.requires_grad = True
-                loss_d = binary_cross_entropy_with_logits_per_sample(cls_d, target, weight=weight) / nframes_d.float()
-                loss_d = loss_d.mean()
-                correct_d = ((cls_d.data > 0).float() * weight.data).sum()
-                num_d = weight.data.sum()
-
-                cs2 = tovar(cs2).long()
-                cl2 = tovar(cl2).long()
-                embed_g = e_g(cs2, cl2)
-                embed_d = e_d(cs2, cl2)
-                fake_data, _, _, fake_len = g(batch_size=batch_size, length=maxlen, c=embed_g)
-                if dis_iter % 2 == 0:
-                    noise = tovar(T.randn(*fake_data.size()) * args.noisescale)
-                    fake_data = tovar((fake_data + noise).data)
-                else:
-                    fake_data = tovar(fake_data.data)
-                    fake_data.requires_grad = True
-                    cls_g, _, _, nframes_g = d(fake_data, fake_len, embed_d)
-                    target = tovar(T.zeros(*(cls_g.size())))
-                    weight = length_mask(cls_g.size(), nframes_g)
-                    advers = adversarial_movement_d(fake_data, fake_len, embed_d, target, weight, d)
-                    fake_data = tovar((fake_data + tovar(advers)).data)
-                fake_data.requires_grad = True
-                cls_g, _, _, nframes_g = d(fake_data, fake_len, embed_d)
-                target = tovar(T.zeros(*(cls_g.size())))
-                weight = length_mask(cls_g.size(), nframes_g)
-
-                #feature_penalty = [T.pow(r - f,2).mean() for r, f in zip(dists_d, dists_g)]
-                loss_g = binary_cross_entropy_with_logits_per_sample(cls_g, target, weight=weight) / nframes_g.float()
-
-                # Check gradient w.r.t. generated output occasionally
-                grad = T.autograd.grad(loss_g, fake_data, grad_outputs=T.ones(loss_g.size()).cuda(), 
-                                       create_graph=True, retain_graph=True, only_inputs=True)[0]
-                                       
-                #advers = (grad > 0).type(T.FloatTensor) *.001 - (grad < 0).type(T.FloatTensor) * .001
-                norm = grad.norm(2, 1) ** 2
-                norm = (norm / nframes_g.float()).data
-                x_grad_norm = norm.mean()
-                d_train_writer.add_summary(
-                        TF.Summary(value=[TF.Summary.Value(tag='x_grad_norm', simple_value=x_grad_norm)]),
-                        dis_iter)
-
-                loss_g = loss_g.mean()
-                correct_g = ((cls_g.data < 0).float() * weight.data).sum()
-                num_g = weight.data.sum()
-                loss = loss_d + loss_g
-                opt_d.zero_grad()
-                loss.backward()
-                check_grad(param_d)
-                d_grad_norm = clip_grad(param_d, args.dgradclip)
-                opt_d.step()
-
-            loss_d, loss_g, loss, cls_d, cls_g = tonumpy(loss_d, loss_g, loss, cls_d, cls_g)
+            opt_d.zero_grad()
+            correct_d = num_d = correct_g = num_g = 0
+            losses_d, losses_g, cls_d_list, cls_g_list = [], [], [], []
+            x_grad_norm = 0
+            # Gradients of --accum_d micro-batches are accumulated into one
+            # optimizer step.  Losses are averaged, so the step is the same
+            # as with a single batch of --accum_d times the size.
+            for k in range(args.accum_d):
+                with Timer.new('load', print_=False):
+                    gc.collect()
+                    epoch, batch_id, real_data, real_len, _, cs, cl = dataloader.next()
+                    _, cs2, cl2, _, _ = dataset.pick_words(
+                            batch_size, maxlen, dataset_h5, keys_train, maxcharlen_train, args, skip_samples=True,
+                            out=words_g)
+                    #last_real_raw = [real_data, real_len]
+                with Timer.new('train_d', print_=False):
+                    # Real and fake batches go through e_d and d together.
+                    with Timer.new('embed'):
+                        cs_all = tovar(NP.concatenate([cs, cs2])).long()
+                        cl_all = tovar(NP.concatenate([cl, cl2])).long()
+                        embed_d = e_d(cs_all, cl_all)
+                        cs2 = tovar(cs2).long()
+                        cl2 = tovar(cl2).long()
+                        embed_g = e_g(cs2, cl2)
+                        real_len = tovar(real_len).long()
+                    with Timer.new('g_forward'):
+                        fake_data, _, _, fake_len = g(batch_size=batch_size, length=maxlen, c=embed_g)
+                    data, data_len = concat_batches([tovar(real_data), tovar(fake_data.data)], [real_len, fake_len])
+                    target_row = tovar(NP.concatenate([NP.ones(batch_size) * 0.9, NP.zeros(batch_size)]))
+                    if perturb_d.active(dis_iter):
+                        embed_d_const = embed_d.detach()
+                        data = perturb_d.perturb(
+                                data, lambda x: classifier_loss(d, x, data_len, embed_d_const, target_row)[0])
+                    else:
+                        noise = tovar(T.randn(*data.size()) * args.noisescale)
+                        data = tovar((data + noise).data)
+                    data.requires_grad = True
+                    if d_window > 0:
+                        with Timer.new('d_forward'):
+                            feats, _, _, nframes = d.features(data, data_len)
+                        with Timer.new('backward'):
+                            # The recurrent part is back-propagated window
+                            # by window, the rest in one pass below.
+                            loss_all, cls, weight, grads = classifier_loss_tbptt(
+                                    d, feats, nframes, embed_d, target_row,
+                                    1. / (batch_size * args.accum_d), d_window)
+                            T.autograd.backward([v for v, g_ in grads], [g_ for v, g_ in grads])
+                    else:
+                        with Timer.new('d_forward'):
+                            loss_all, cls, weight, nframes = classifier_loss(d, data, data_len, embed_d, target_row)
+                    (loss_d, cls_d, weight_d, _), (loss_g, cls_g, weight_g, nframes_g) = \
+                            split_batch([loss_all, cls, weight, nframes], [batch_size, batch_size])
+
+                    loss_d = loss_d.mean()
+                    correct_d += ((cls_d.data > 0).float() * weight_d.data).sum()
+                    num_d += weight_d.data.sum()
+                    loss_g = loss_g.mean()
+                    correct_g += ((cls_g.data < 0).float() * weight_g.data).sum()
+                    num_g += weight_g.data.sum()
+                    loss = (loss_d + loss_g) / args.accum_d
+                    if d_window == 0:
+                        with Timer.new('backward'):
+                            loss.backward()
+
+                    # Gradient w.r.t. generated output, taken from the main
+                    # backward pass: d(loss)/d(fake) = d(sum(loss_g))/d(fake) / batch_size / accum_d
+                    grad = data.grad.data[batch_size:] * (batch_size * args.accum_d)
+                    norm = grad.norm(2, 1) ** 2
+                    norm = norm / nframes_g.data.float()
+                    x_grad_norm += norm.mean() / args.accum_d
+
+                    if k == args.accum_d - 1:
+                        if args.world_size > 1:
+                            with Timer.new('allreduce'):
+                                distributed.allreduce_grads(param_d, args.world_size)
+                        with Timer.new('step'):
+                            d_grad_norm = check_and_clip_grad(param_d, args.dgradclip, args.gradclip_mode)
+                            opt_d.step()
+
+                loss_d, loss_g, cls_d, cls_g, weight_d, weight_g = \
+                        tonumpy(loss_d, loss_g, cls_d, cls_g, weight_d, weight_g)
+                losses_d.append(loss_d)
+                losses_g.append(loss_g)
+                # Micro-batches are padded to different lengths; keep only
+                # the real frames so that they can be concatenated.
+                cls_d_list.append(cls_d[weight_d > 0])
+                cls_g_list.append(cls_g[weight_g > 0])
+            batch_pool.recycle()
+
+            d_train_writer.add_summary(
+                    TF.Summary(value=[TF.Summary.Value(tag='x_grad_norm', simple_value=x_grad_norm)]),
+                    dis_iter)
+            loss_d = NP.mean(losses_d)
+            loss_g = NP.mean(losses_g)
+            loss = loss_d + loss_g
+            cls_d = NP.concatenate(cls_d_list)
+            cls_g = NP.concatenate(cls_g_list)
+            if args.world_size > 1:
+                # All ranks must take the same early exit below
+                correct_d, num_d, correct_g, num_g = distributed.allreduce_sum([correct_d, num_d, correct_g, num_g])
             acc_d = correct_d / num_d
             acc_g = correct_g / num_g
             d_train_writer.add_summary(
@@ -813,128 +1180,190 @@ if __name__ == '__main__':
             if acc_d > args.require_acc and acc_g > args.require_acc:
                 break
 
-        for p in param_g:
-            p.requires_grad = True
         for p in param_d:
             p.requires_grad = False
         #real_data, real_len = last_real_raw[0], last_real_raw[1]
         for _ in range(args.gencatchup):
             gen_iter += 1
-            _, _, real_data, real_len, _, _, _ = dataloader.next()
-            noise = tovar(RNG.randn(*real_data.shape) * args.noisescale)
-            real_data = tovar(real_data) + noise
-            real_len = tovar(real_len).long()
-            _, cs, cl, _, _ = dataset.pick_words(
-                    batch_size, maxlen, dataset_h5, keys_train, maxcharlen_train, args, skip_samples=True)
-            with Timer.new('train_g', print_=False):
-                cs = tovar(cs).long()
-                cl = tovar(cl).long()
-                embed_g = e_g(cs, cl)
-                embed_d = e_d(cs, cl)
-                nframes = div_roundup(maxlen, g._frame_size)
-                
-                z = adversarially_sample_z(batch_size, nframes, g._noise_size, maxlen, embed_g, args.noisescale, embed_d, real_data, real_len, 
-                                           args.g_optim, args.framesize, scale=1e-2)
-    
-    
-    
-                fake_data, fake_s, fake_stop_list, fake_len = g(batch_size=batch_size, length=maxlen, c=embed_g, z = z)
-                noise = tovar(T.randn(*fake_data.size()) * args.noisescale)
-                fake_data += noise
-                
-                cls_g, hidden_states_g, hidden_states_length_g, nframes_g = d(fake_data, fake_len, embed_d)
-                
-                _, hidden_states_d, hidden_states_length_d, nframes_d = d(real_data, real_len, embed_d)
-                dists_d = calc_dists(hidden_states_d, hidden_states_length_d)
-                dists_g = calc_dists(hidden_states_g, hidden_states_length_g)
-                feature_penalty = 0
-                #dists are (object, std) pairs.
-                #penalizing z-scores of gen from real distribution
-                #Note that the model could not do anything to r[1] by optimizing G.
-                for r, f in zip(dists_d, dists_g):
-                    feature_penalty += T.pow((r[0] - f[0]), 2).mean() / batch_size
-    
-                if args.g_optim == 'boundary_seeking':
-                    target = tovar(T.ones(*(cls_g.size())) * 0.5)   # TODO: add logZ estimate, may be unnecessary
-                else:
-                    target = tovar(T.zeros(*(cls_g.size())))            
-                weight = length_mask(cls_g.size(), nframes_g)
-                nframes_max = (fake_len / args.framesize).data.max()
-                weight_r = length_mask((batch_size, nframes_max), fake_len / args.framesize)
-                loss = binary_cross_entropy_with_logits_per_sample(cls_g, target, weight=weight) / nframes_g.float()
-    
-    
-    
-    
-    
-    
-    
-                
-                reward = -loss.data
-                baseline = reward.mean() if baseline is None else (baseline * 0.5 + reward.mean() * 0.5)
-                d_train_writer.add_summary(
-                        TF.Summary(
-                            value=[
-                                TF.Summary.Value(tag='reward_baseline', simple_value=baseline),
-                                TF.Summary.Value(tag='reward/mean', simple_value=reward.cpu().numpy().mean()),
-                                TF.Summary.Value(tag='reward/std', simple_value=reward.cpu().numpy().std()),
-                                ]
-                            ),
-                        gen_iter
-                        )
-                reward = (reward - baseline).unsqueeze(1) * weight_r.data
-    
-                '''
-                fp_raw = tonumpy(feature_penalty)
-                if fp_raw  * lambda_fp > 100:
-                    lambda_fp *= .2
-                if fp_raw  * lambda_fp > 10:
-                    lambda_fp *= .9
-                if fp_raw  * lambda_fp < 1:
-                    lambda_fp *= 1.1
-                '''
-    
-                _loss = loss.mean()
-                loss = _loss + feature_penalty * lambda_fp
-                #loss = _loss
-                for i, fake_stop in enumerate(fake_stop_list):
-                    fake_stop.reinforce(reward[:, i:i+1])
-                opt_g.zero_grad()
-                loss.backward(retain_graph=True)
+            opt_g.zero_grad()
+            losses, penalties, rewards = [], [], []
+            baseline_prev = baseline
+            for k in range(args.accum_g):
+                # The stopper-only backward pass below turns these off
                 for p in param_g:
-                    p.requires_grad = False
-                for p in g.stopper.parameters():
                     p.requires_grad = True
-                T.autograd.backward(fake_stop_list, [None for _ in fake_stop_list])
-                check_grad(param_g)
-                g_grad_norm = clip_grad(param_g, args.ggradclip)
-                d_train_writer.add_summary(
-                        TF.Summary(
-                            value=[
-                                TF.Summary.Value(tag='g_grad_norm', simple_value=g_grad_norm),
-                                TF.Summary.Value(tag='feature_penalty', simple_value=tonumpy(feature_penalty)[0]),
-                                TF.Summary.Value(tag='lambda_fp', simple_value=lambda_fp),
-                                ]
-                            ),
-                        gen_iter
-                        )
-                opt_g.step()
-    
-            if gen_iter % 20 == 0:
-                embed_g = e_g(cseq_fixed, clen_fixed)
-                fake_data, _, _, fake_len = g(z=z_fixed, c=embed_g)
+                with Timer.new('load', print_=False):
+                    _, _, real_data, real_len, _, _, _ = dataloader.next()
+                    noise = tovar(RNG.randn(*real_data.shape) * args.noisescale)
+                    real_data = tovar(real_data) + noise
+                    real_len = tovar(real_len).long()
+                    _, cs, cl, _, _ = dataset.pick_words(
+                            batch_size, maxlen, dataset_h5, keys_train, maxcharlen_train, args, skip_samples=True,
+                            out=words_g)
+                with Timer.new('train_g', print_=False):
+                    with Timer.new('embed'):
+                        cs = tovar(cs).long()
+                        cl = tovar(cl).long()
+                        embed_g = e_g(cs, cl)
+                        embed_d = e_d(cs, cl)
+                    nframes = div_roundup(maxlen, g._frame_size)
+                    target_g = 0.5 if args.g_optim == 'boundary_seeking' else 0.   # TODO: add logZ estimate, may be unnecessary
+
+                    z = tovar(T.randn(batch_size, nframes, g._noise_size))
+                    if perturb_z.active(gen_iter):
+                        embed_g_const = embed_g.detach()
+                        embed_d_const = embed_d.detach()
+                        target_row = tovar(NP.ones(batch_size) * target_g)
+                        def z_loss(z):
+                            fake_data, _, _, fake_len = g(batch_size=batch_size, length=maxlen, c=embed_g_const, z=z)
+                            fake_data = fake_data + tovar(T.randn(*fake_data.size()) * args.noisescale)
+                            return classifier_loss(d, fake_data, fake_len, embed_d_const, target_row)[0]
+                        z = perturb_z.perturb(z, z_loss)
+
+                    with Timer.new('g_forward'):
+                        fake_data, fake_s, fake_stop_list, fake_len = g(batch_size=batch_size, length=maxlen, c=embed_g, z = z)
+                    noise = tovar(T.randn(*fake_data.size()) * args.noisescale)
+                    fake_data += noise
+
+                    with Timer.new('d_forward'):
+                        if d_window > 0:
+                            # Only the features of the real batch are needed
+                            x_all, len_all = concat_batches([fake_data, real_data], [fake_len, real_len])
+                            feats, stats, _, nframes_all = d.features(x_all, len_all, stats=True)
+                            (feats_g, stats_g, nframes_g), (_, stats_d, _) = \
+                                    split_batch([feats, stats, nframes_all], [batch_size, batch_size])
+                        else:
+                            (cls_g, stats_g, _, nframes_g), (_, stats_d, _, nframes_d) = \
+                                    d.forward_split([fake_data, real_data], [fake_len, real_len], [embed_d, embed_d],
+                                                    stats=True)
+                    dists_d = calc_dists(stats_d)
+                    dists_g = calc_dists(stats_g)
+                    feature_penalty = 0
+                    #dists are (object, std) pairs.
+                    #penalizing z-scores of gen from real distribution
+                    #Note that the model could not do anything to r[1] by optimizing G.
+                    #Normalized by the size of the whole step over all ranks, as for one
+                    #large batch, although the statistics are only compared within this
+                    #micro-batch.
+                    for r, f in zip(dists_d, dists_g):
+                        feature_penalty += T.pow((r[0] - f[0]), 2).mean() / (args.batchsize * args.accum_g)
+
+                    nframes_max = (fake_len / args.framesize).data.max()
+                    weight_r = length_mask((batch_size, nframes_max), fake_len / args.framesize)
+                    if d_window > 0:
+                        with Timer.new('backward'):
+                            loss, cls_g, weight, d_grads = classifier_loss_tbptt(
+                                    d, feats_g, nframes_g, embed_d, tovar(NP.ones(batch_size) * target_g),
+                                    1. / (batch_size * args.accum_g), d_window)
+                    else:
+                        target = tovar(T.ones(*(cls_g.size())) * target_g)
+                        weight = length_mask(cls_g.size(), nframes_g)
+                        loss = binary_cross_entropy_with_logits_per_sample(cls_g, target, weight=weight) / nframes_g.float()
+
+                    reward = -loss.data
+                    rewards.append(reward.cpu().numpy())
+                    # Blend the previous baseline with the mean reward of
+                    # this step so far.  Micro-batch k only sees the rewards
+                    # of micro-batches 0..k, so unlike a single large batch
+                    # the earlier ones are centred on a partial mean; the
+                    # baseline kept for the next step covers all of them.
+                    reward_mean = NP.concatenate(rewards).mean()
+                    baseline = reward_mean if baseline_prev is None else (baseline_prev * 0.5 + reward_mean * 0.5)
+                    reward = (reward - baseline).unsqueeze(1) * weight_r.data
+
+                    '''
+                    fp_raw = tonumpy(feature_penalty)
+                    if fp_raw  * lambda_fp > 100:
+                        lambda_fp *= .2
+                    if fp_raw  * lambda_fp > 10:
+                        lambda_fp *= .9
+                    if fp_raw  * lambda_fp < 1:
+                        lambda_fp *= 1.1
+                    '''
+
+                    _loss = loss.mean()
+                    loss = (_loss + feature_penalty * lambda_fp) / args.accum_g
+                    #loss = _loss
+                    # REINFORCE gradients are summed over samples, so summing
+                    # them over micro-batches already matches one large batch,
+                    # and the all-reduce average over ranks has to be undone.
+                    for i, fake_stop in enumerate(fake_stop_list):
+                        fake_stop.reinforce(reward[:, i:i+1] * args.world_size)
+                    with Timer.new('backward'):
+                        if d_window > 0:
+                            # The classification loss has already been
+                            # back-propagated down to the features of D.
+                            T.autograd.backward(
+                                    [feature_penalty * lambda_fp / args.accum_g] + [v for v, g_ in d_grads],
+                                    [None] + [g_ for v, g_ in d_grads],
+                                    retain_graph=True)
+                        else:
+                            loss.backward(retain_graph=True)
+                        for p in param_g:
+                            p.requires_grad = False
+                        for p in g.stopper.parameters():
+                            p.requires_grad = True
+                        T.autograd.backward(fake_stop_list, [None] * len(fake_stop_list))
+
+                    if k == args.accum_g - 1:
+                        if args.world_size > 1:
+                            with Timer.new('allreduce'):
+                                distributed.allreduce_grads(param_g, args.world_size)
+                        with Timer.new('step'):
+                            g_grad_norm = check_and_clip_grad(param_g, args.ggradclip, args.gradclip_mode)
+                            opt_g.step()
+                losses.append(tonumpy(_loss))
+                penalties.append(tonumpy(feature_penalty))
+
+            batch_pool.recycle()
+            rewards = NP.concatenate(rewards)
+            d_train_writer.add_summary(
+                    TF.Summary(
+                        value=[
+                            TF.Summary.Value(tag='reward_baseline', simple_value=baseline),
+                            TF.Summary.Value(tag='reward/mean', simple_value=rewards.mean()),
+                            TF.Summary.Value(tag='reward/std', simple_value=rewards.std()),
+                            TF.Summary.Value(tag='g_grad_norm', simple_value=g_grad_norm),
+                            TF.Summary.Value(tag='feature_penalty', simple_value=NP.mean(penalties)),
+                            TF.Summary.Value(tag='lambda_fp', simple_value=lambda_fp),
+                            ]
+                        ),
+                    gen_iter
+                    )
+
+            if is_chief and gen_iter % 20 == 0:
+                with evaluation.no_grad():
+                    embed_g = e_g(cseq_fixed, clen_fixed)
+                    fake_data, _, _, fake_len = g(z=z_fixed, c=embed_g)
                 fake_data, fake_len = tonumpy(fake_data, fake_len)
-    
+
                 for batch in range(batch_size):
                     fake_sample = fake_data[batch, :fake_len[batch]]
                     add_waveform_summary(d_train_writer, cseq[batch], fake_sample, gen_iter)
-    
+
                 if gen_iter % 500 == 0:
                     for batch in range(batch_size):
                         fake_sample = fake_data[batch, :fake_len[batch]]
                         add_audio_summary(d_train_writer, cseq[batch], fake_sample, fake_len[batch], gen_iter)
-                    T.save(d, '%s-dis-%05d' % (modelnamesave, gen_iter + args.loaditerations))
-                    T.save(g, '%s-gen-%05d' % (modelnamesave, gen_iter + args.loaditerations))
-                    T.save(e_g, '%s-eg-%05d' % (modelnamesave, gen_iter + args.loaditerations))
-                    T.save(e_d, '%s-ed-%05d' % (modelnamesave, gen_iter + args.loaditerations))
-            print 'G', gen_iter, tonumpy(_loss), tonumpy(feature_penalty), lambda_fp, Timer.get('train_g')
+
+            if is_chief and gen_iter % args.checkpoint_every == 0:
+                checkpointer.save(
+                        gen_iter + args.loaditerations,
+                        checkpoint_modules,
+                        checkpoint_optimizers,
+                        dis_iter=dis_iter,
+                        baseline=baseline,
+                        )
+            if is_chief and args.val_every > 0 and gen_iter % args.val_every == 0:
+                with Timer.new('validate', print_=False):
+                    val_metrics = validation.validate(d, e_d, valset, args.val_buckets)
+                d_train_writer.add_summary(
+                        TF.Summary(value=[
+                            TF.Summary.Value(tag='val/%s' % k, simple_value=v) for k, v in sorted(val_metrics.items())]),
+                        gen_iter)
+                print 'Val', gen_iter, val_metrics['loss'], val_metrics['acc'], Timer.get('validate')
+            print 'G', gen_iter, NP.mean(losses), NP.mean(penalties), lambda_fp, Timer.get('train_g')
+
+            if is_chief and args.profile_every > 0 and gen_iter % args.profile_every == 0:
+                add_profile_summary(d_train_writer, gen_iter)
+                print Timer.format_report()
@@ -0,0 +1,422 @@
+#! /usr/bin/env python
+# Micro-benchmarks for the modules in audiogan.py and the loaders in dataset.py.
+#
+# Usage:
+# python benchmark.py [--batchsizes 1,8,32] [--maxlens 8000,40000] [--framesizes 200]
+#                     [--statesizes 256,1024]
+#                     [--compile] [--only generator,discriminator]
+#                     [--output bench.json] [--compare old-bench.json]
+#
+# Every case runs in its own process on synthetic data so that the reported
+# peak memory only covers that case.  Results are written as JSON together
+# with the current git commit, so that runs from different commits can be
+# compared with --compare.  Traced cases are also reported relative to the
+# matching eager cases of the same run.
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing as MP
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+
+import numpy as NP
+import numpy.random as RNG
+import torch as T
+import h5py
+
+import audiogan
+import dataset
+from timer import Timer
+
+SAMPLE_RATE = 8000
+EMBED_SIZE = 100
+NOISE_SIZE = 100
+MAXCHARLEN = 10
+
+
+def _chars(batch_size):
+    clen = RNG.randint(1, MAXCHARLEN + 1, batch_size)
+    cseq = NP.zeros((batch_size, MAXCHARLEN))
+    for i in range(batch_size):
+        cseq[i, :clen[i]] = RNG.randint(ord('a'), ord('z') + 1, clen[i])
+    cseq, clen = audiogan.tovar(cseq, clen)
+    return cseq.long(), clen.long()
+
+
+def _audio(batch_size, maxlen, framesize):
+    maxlen = audiogan.roundup(maxlen, framesize)
+    length = audiogan.roundup(RNG.randint(maxlen // 2, maxlen + 1, batch_size), framesize)
+    x = RNG.uniform(-1, 1, (batch_size, maxlen))
+    x *= NP.arange(maxlen)[NP.newaxis] < length[:, NP.newaxis]
+    x, length = audiogan.tovar(x, length)
+    return x, length.long()
+
+
+def _generator(cfg):
+    g = audiogan.cuda(audiogan.Generator(
+            frame_size=cfg['framesize'],
+            noise_size=NOISE_SIZE,
+            state_size=cfg['state_size'],
+            embed_size=EMBED_SIZE,
+            ))
+    if cfg.get('compile'):
+        audiogan.compile_models(g=g, batch_size=cfg['batch_size'])
+    return g
+
+
+def _discriminator(cfg, checkpoint_activations=False):
+    d = audiogan.cuda(audiogan.Discriminator(
+            state_size=cfg['state_size'],
+            embed_size=EMBED_SIZE,
+            checkpoint_activations=checkpoint_activations,
+            ))
+    if cfg.get('compile'):
+        audiogan.compile_models(d=d, batch_size=cfg['batch_size'])
+    return d
+
+
+def bench_embedder(cfg):
+    e = audiogan.cuda(audiogan.Embedder(EMBED_SIZE))
+    cseq, clen = _chars(cfg['batch_size'])
+    def run():
+        e(cseq, clen)
+        return 0
+    return run
+
+
+def bench_generator(cfg):
+    g = _generator(cfg)
+    c = audiogan.tovar(T.randn(cfg['batch_size'], EMBED_SIZE))
+    def run():
+        _, _, _, length = g(batch_size=cfg['batch_size'], length=cfg['maxlen'], c=c)
+        return audiogan.tonumpy(length).sum()
+    return run
+
+
+def bench_generator_train(cfg):
+    # forward and backward of the generator output (without REINFORCE)
+    g = _generator(cfg)
+    c = audiogan.tovar(T.randn(cfg['batch_size'], EMBED_SIZE))
+    def run():
+        g.zero_grad()
+        x, _, _, length = g(batch_size=cfg['batch_size'], length=cfg['maxlen'], c=c)
+        loss = (x ** 2).mean()
+        loss.backward()
+        return audiogan.tonumpy(length).sum()
+    return run
+
+
+def bench_discriminator(cfg):
+    d = _discriminator(cfg)
+    x, length = _audio(cfg['batch_size'], cfg['maxlen'], cfg['framesize'])
+    c = audiogan.tovar(T.randn(cfg['batch_size'], EMBED_SIZE))
+    naudio = audiogan.tonumpy(length).sum()
+    def run():
+        d(x, length, c)
+        return naudio
+    return run
+
+
+def bench_discriminator_train(cfg, checkpoint_activations=False):
+    # forward, classification loss and backward of the discriminator
+    d = _discriminator(cfg, checkpoint_activations)
+    x, length = _audio(cfg['batch_size'], cfg['maxlen'], cfg['framesize'])
+    c = audiogan.tovar(T.randn(cfg['batch_size'], EMBED_SIZE))
+    naudio = audiogan.tonumpy(length).sum()
+    def run():
+        d.zero_grad()
+        cls, _, _, nframes = d(x, length, c)
+        target = audiogan.tovar(T.ones(*cls.size()) * 0.9)
+        weight = audiogan.length_mask(cls.size(), nframes)
+        loss = audiogan.binary_cross_entropy_with_logits_per_sample(cls, target, weight=weight) / nframes.float()
+        loss.mean().backward()
+        return naudio
+    return run
+
+
+def bench_discriminator_train_checkpoint(cfg):
+    # same, recomputing the activations in backward
+    return bench_discriminator_train(cfg, checkpoint_activations=True)
+
+
+def bench_dynamic_rnn(cfg):
+    input_size = cfg['framesize'] + EMBED_SIZE
+    rnn = audiogan.cuda(T.nn.LSTM(input_size, cfg['state_size'] // 2, 1, bidirectional=True))
+    x, length = _audio(cfg['batch_size'], cfg['maxlen'], cfg['framesize'])
+    nframes = length / cfg['framesize']
+    max_nframes = int(audiogan.tonumpy(nframes).max())
+    seq = audiogan.tovar(T.randn(max_nframes, cfg['batch_size'], input_size))
+    initial_state = (
+            audiogan.tovar(T.zeros(2, cfg['batch_size'], cfg['state_size'] // 2)),
+            audiogan.tovar(T.zeros(2, cfg['batch_size'], cfg['state_size'] // 2)),
+            )
+    naudio = audiogan.tonumpy(length).sum()
+    def run():
+        audiogan.dynamic_rnn(rnn, seq, nframes, initial_state)
+        return naudio
+    return run
+
+
+def bench_length_mask(cfg):
+    _, length = _audio(cfg['batch_size'], cfg['maxlen'], cfg['framesize'])
+    nframes = length / cfg['framesize']
+    size = (cfg['batch_size'], int(audiogan.tonumpy(nframes).max()))
+    naudio = audiogan.tonumpy(length).sum()
+    def run():
+        audiogan.length_mask(size, nframes)
+        return naudio
+    return run
+
+
+def bench_calc_dists(cfg):
+    # per-layer statistics of the discriminator conv stack and their distances
+    x, length = _audio(cfg['batch_size'], cfg['maxlen'], cfg['framesize'])
+    hidden_states = []
+    hidden_state_lengths = []
+    nframes = length
+    for _, stride, filters in audiogan.Discriminator(state_size=256, embed_size=EMBED_SIZE).cnn_struct:
+        nframes = (nframes + stride - 1) / stride
+        hidden_states.append(audiogan.tovar(T.randn(cfg['batch_size'], filters, int(audiogan.tonumpy(nframes).max()))))
+        hidden_state_lengths.append(nframes)
+    naudio = audiogan.tonumpy(length).sum()
+    def run():
+        audiogan.calc_dists([audiogan.layer_stats(h, l) for h, l in zip(hidden_states, hidden_state_lengths)])
+        return naudio
+    return run
+
+
+def bench_conditional_loader(cfg):
+    args = argparse.Namespace(dataset=cfg['conditional_dataset'], minwordlen=1, conditional=True)
+    _, _, loader, _, _, _ = dataset.conditional_dataloader(
+            cfg['batch_size'], args, maxlen=cfg['maxlen'], frame_size=cfg['framesize'])
+    def run():
+        _, _, _, lengths, _, _, _ = next(loader)
+        return lengths.sum()
+    return run
+
+
+def bench_unconditional_loader(cfg):
+    args = argparse.Namespace(dataset=cfg['unconditional_dataset'], subset=0, amplitudes=SAMPLE_RATE, conditional=False)
+    _, loader, _ = dataset.unconditional_dataloader(cfg['batch_size'], args)
+    def run():
+        _, _, samples = next(loader)[:3]
+        return samples.size
+    return run
+
+
+# name -> (benchmark setup, configuration axes it depends on)
+BENCHMARKS = [
+        ('embedder', bench_embedder, ['batch_size']),
+        ('generator', bench_generator, ['batch_size', 'maxlen', 'framesize', 'state_size', 'compile']),
+        ('generator_train', bench_generator_train,
+            ['batch_size', 'maxlen', 'framesize', 'state_size', 'compile']),
+        ('discriminator', bench_discriminator, ['batch_size', 'maxlen', 'state_size', 'compile']),
+        ('discriminator_train', bench_discriminator_train, ['batch_size', 'maxlen', 'state_size', 'compile']),
+        ('discriminator_train_checkpoint', bench_discriminator_train_checkpoint,
+            ['batch_size', 'maxlen', 'state_size']),
+        ('dynamic_rnn', bench_dynamic_rnn, ['batch_size', 'maxlen', 'framesize', 'state_size']),
+        ('length_mask', bench_length_mask, ['batch_size', 'maxlen', 'framesize']),
+        ('calc_dists', bench_calc_dists, ['batch_size', 'maxlen']),
+        ('conditional_loader', bench_conditional_loader, ['batch_size', 'maxlen', 'framesize']),
+        ('unconditional_loader', bench_unconditional_loader, ['batch_size']),
+        ]
+AXES = ['batch_size', 'maxlen', 'framesize', 'state_size', 'compile']
+
+
+def make_synthetic_datasets(workdir, maxlen, nwords=200, nsamples_per_word=20, nsamples=2000):
+    conditional = os.path.join(workdir, 'conditional.h5')
+    with h5py.File(conditional, 'w') as f:
+        for i in range(nwords):
+            word = ''.join(chr(c) for c in RNG.randint(ord('a'), ord('z') + 1, RNG.randint(1, MAXCHARLEN + 1)))
+            if word in f:
+                continue
+            length = RNG.randint(maxlen // 4, maxlen + 1, nsamples_per_word)
+            data = RNG.uniform(-1, 1, (nsamples_per_word, length.max()))
+            data *= NP.arange(length.max())[NP.newaxis] < length[:, NP.newaxis]
+            f.create_dataset(word, data=data.astype(NP.float32))
+
+    unconditional = os.path.join(workdir, 'unconditional.h5')
+    with h5py.File(unconditional, 'w') as f:
+        f.create_dataset('data', data=RNG.uniform(-1, 1, (nsamples, SAMPLE_RATE)).astype(NP.float32))
+
+    return conditional, unconditional
+
+
+def peak_memory():
+    if audiogan.use_cuda and hasattr(T.cuda, 'max_memory_allocated'):
+        return T.cuda.max_memory_allocated() / 2. ** 20
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2. ** 10
+
+
+def run_case(name, setup, cfg, args, queue):
+    try:
+        RNG.seed(args.seed)
+        T.manual_seed(args.seed)
+        audiogan.use_cuda = args.cuda
+        Timer.reset()
+
+        mem_before = peak_memory()
+        run = setup(cfg)
+        for _ in range(args.warmup):
+            run()
+        naudio = 0
+        for _ in range(args.repeat):
+            with Timer.new(name):
+                naudio += run()
+        mem_after = peak_memory()
+
+        stats = Timer.stats(name)
+        seconds = stats['mean'] * stats['count']
+        result = dict((k, cfg[k]) for k in AXES if k in cfg)
+        result.update({
+            'benchmark': name,
+            'device': 'cuda' if args.cuda else 'cpu',
+            'seconds/p50': stats['p50'],
+            'seconds/p95': stats['p95'],
+            'samples/s': cfg['batch_size'] * args.repeat / seconds,
+            'audio-seconds/s': float(naudio) / SAMPLE_RATE / seconds,
+            'peak_memory_mb': mem_after - mem_before,
+            })
+        queue.put(result)
+    except Exception as e:
+        queue.put({'benchmark': name, 'error': repr(e)})
+
+
+def case_key(result):
+    return tuple([result['benchmark'], result.get('device')] + [result.get(k) for k in AXES])
+
+
+def compare(results, baseline, tolerance):
+    baseline = dict((case_key(r), r) for r in baseline['results'] if 'error' not in r)
+    regressions = 0
+    for r in results:
+        old = baseline.get(case_key(r))
+        if old is None or 'error' in r:
+            continue
+        ratio = r['samples/s'] / old['samples/s']
+        flag = ''
+        if ratio < 1 - tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        print('%-20s %s  %.3fx samples/s  %+.1fMB peak memory  %s' % (
+            r['benchmark'], ' '.join('%s=%s' % (k, r[k]) for k in AXES if k in r),
+            ratio, r['peak_memory_mb'] - old['peak_memory_mb'], flag))
+    return regressions
+
+
+def report_relative(results, axis, base_value, label):
+    '''
+    Annotates every result whose @axis is not @base_value with its speedup
+    (in samples/s, i.e. steps/s) and memory saving relative to the result of
+    the same case with @base_value.
+    '''
+    bases = {}
+    for r in results:
+        if 'error' not in r and r.get(axis) == base_value:
+            bases[case_key(dict(r, **{axis: None}))] = r
+    for r in results:
+        if 'error' in r or r.get(axis) in [None, base_value]:
+            continue
+        base = bases.get(case_key(dict(r, **{axis: None})))
+        if base is None:
+            continue
+        r['speedup_vs_%s' % label] = r['samples/s'] / base['samples/s']
+        r['memory_saving_vs_%s_mb' % label] = base['peak_memory_mb'] - r['peak_memory_mb']
+        print('%-20s %s  %.3fx speedup  %.1fMB memory saving vs %s' % (
+            r['benchmark'], ' '.join('%s=%s' % (k, r[k]) for k in AXES if k in r),
+            r['speedup_vs_%s' % label], r['memory_saving_vs_%s_mb' % label], label))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).strip().decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batchsizes', type=int_list, default=[1, 8, 32])
+    parser.add_argument('--maxlens', type=int_list, default=[8000, 40000])
+    parser.add_argument('--framesizes', type=int_list, default=[200])
+    parser.add_argument('--statesizes', type=int_list, default=[256, 1024])
+    parser.add_argument('--compile', action='store_true', help='also run the model benchmarks with traced graphs')
+    parser.add_argument('--only', type=str, default='', help='comma-separated benchmarks to run (default all)')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cuda', action='store_true', help='benchmark on CUDA instead of CPU')
+    parser.add_argument('--output', type=str, default='bench.json')
+    parser.add_argument('--compare', type=str, default='', help='previous JSON output to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    only = set(args.only.split(',')) if args.only else None
+    grid = {
+            'batch_size': args.batchsizes,
+            'maxlen': args.maxlens,
+            'framesize': args.framesizes,
+            'state_size': args.statesizes,
+            'compile': [False, True] if args.compile else [False],
+            }
+
+    workdir = tempfile.mkdtemp()
+    try:
+        conditional, unconditional = make_synthetic_datasets(workdir, max(args.maxlens))
+        results = []
+        for name, setup, axes in BENCHMARKS:
+            if only is not None and name not in only:
+                continue
+            for values in itertools.product(*[grid[a] for a in axes]):
+                cfg = dict(zip(axes, values))
+                cfg.setdefault('framesize', args.framesizes[0])
+                cfg.setdefault('maxlen', max(args.maxlens))
+                cfg['conditional_dataset'] = conditional
+                cfg['unconditional_dataset'] = unconditional
+
+                queue = MP.Queue()
+                proc = MP.Process(target=run_case, args=(name, setup, cfg, args, queue))
+                proc.start()
+                result = queue.get()
+                proc.join()
+                for k in ['framesize', 'maxlen']:
+                    if k not in axes:
+                        result.pop(k, None)
+                results.append(result)
+
+                if 'error' in result:
+                    print('%-20s %s' % (name, result['error']))
+                else:
+                    print('%-20s %s  %10.2f samples/s  %10.2f audio-s/s  %8.1fMB' % (
+                        name, ' '.join('%s=%s' % (k, cfg[k]) for k in axes),
+                        result['samples/s'], result['audio-seconds/s'], result['peak_memory_mb']))
+    finally:
+        shutil.rmtree(workdir)
+
+    report_relative(results, 'compile', False, 'eager')
+
+    output = {
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(),
+            'torch': T.__version__,
+            'device': 'cuda' if args.cuda else 'cpu',
+            'results': results,
+            }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        print('%d regression(s) against %s' % (regressions, baseline.get('commit')))
@@ -0,0 +1,77 @@
+
+# Reusable batch buffers shared between NumPy and PyTorch.
+#
+# The data loader fills float32 arrays handed out by a BufferPool, and the
+# training step wraps them as tensors without a copy or a cast.  With
+# pinning the buffers are page-locked, so the transfer to the GPU does not
+# go through a staging copy.  The training loop calls recycle() after each
+# optimizer step, when nothing reads the batches of that step any more.
+
+import numpy as NP
+import torch as T
+
+
+class BufferPool(object):
+    '''
+    Pool of preallocated float32 buffers, allocated on demand per shape and
+    reused afterwards, so that it grows to the number of batches one step
+    holds and then stays fixed.
+
+    pin: allocate the buffers in page-locked memory
+    '''
+    def __init__(self, pin=False):
+        self.pin = pin
+        self._tensors = []
+        self._free = {}         # shape -> indices of free buffers
+        self._in_use = {}       # data pointer -> index of acquired buffer
+
+    def __len__(self):
+        return len(self._tensors)
+
+    def _allocate(self, shape):
+        t = T.FloatTensor(*shape).zero_()
+        if self.pin:
+            t = t.pin_memory()
+        self._tensors.append(t)
+        return len(self._tensors) - 1
+
+    def acquire(self, shape):
+        '''
+        Returns a float32 array of @shape which stays reserved until the
+        next recycle().  Its contents are those of its last use.
+        '''
+        shape = tuple(shape)
+        free = self._free.setdefault(shape, [])
+        i = free.pop() if len(free) > 0 else self._allocate(shape)
+        array = self._tensors[i].numpy()
+        self._in_use[array.ctypes.data] = i
+        return array
+
+    def tensor(self, array):
+        '''
+        The tensor sharing memory with @array if it is an acquired buffer,
+        or None otherwise.
+        '''
+        i = self._in_use.get(array.ctypes.data)
+        if i is None or self._tensors[i].numel() != array.size:
+            return None
+        return self._tensors[i]
+
+    def recycle(self):
+        '''
+        Returns all acquired buffers to the pool.
+        '''
+        for i in self._in_use.values():
+            self._free[tuple(self._tensors[i].size())].append(i)
+        self._in_use.clear()
+
+
+def as_tensor(array, pool=None):
+    '''
+    Wraps @array as a float tensor, without copying if it is a buffer of
+    @pool or already a contiguous float32 array.
+    '''
+    t = pool.tensor(array) if pool is not None else None
+    if t is None:
+        t = T.from_numpy(NP.ascontiguousarray(array, dtype=NP.float32))
+    return t
@@ -0,0 +1,121 @@
+
+import os
+import re
+import glob
+import threading
+
+import torch as T
+
+
+def _to_host(obj):
+    # Deep-copy every tensor in a (possibly nested) state dict into host
+    # memory, so that the training thread can keep updating the parameters
+    # while the snapshot is being written.
+    if T.is_tensor(obj):
+        return obj.cpu() if obj.is_cuda else obj.clone()
+    elif isinstance(obj, dict):
+        return type(obj)((k, _to_host(v)) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(_to_host(v) for v in obj)
+    else:
+        return obj
+
+
+def checkpoint_path(prefix, step):
+    return '%s-%05d.ckpt' % (prefix, step)
+
+
+def list_checkpoints(prefix):
+    '''
+    Returns a list of (step, path) of the checkpoints under the given prefix,
+    sorted by step.
+    '''
+    pattern = re.compile(re.escape(prefix) + r'-(\d+)\.ckpt$')
+    result = []
+    for path in glob.glob(prefix + '-*.ckpt'):
+        match = pattern.match(path)
+        if match:
+            result.append((int(match.group(1)), path))
+    return sorted(result)
+
+
+def latest_checkpoint(prefix):
+    ckpts = list_checkpoints(prefix)
+    return ckpts[-1] if len(ckpts) > 0 else (None, None)
+
+
+class Checkpointer(object):
+    '''
+    Saves the state dicts of a set of modules and optimizers from a background
+    thread.
+
+    The state is first snapshotted into host memory on the calling thread,
+    then written to a temporary file and atomically renamed to
+    @prefix-<step>.ckpt.  Only the last @keep checkpoints are retained
+    (0 keeps everything).
+    '''
+    def __init__(self, prefix, keep=5):
+        self.prefix = prefix
+        self.keep = keep
+        self._thread = None
+        self._error = None
+
+    def snapshot(self, modules, optimizers, **extra):
+        state = {
+                'modules': dict((k, _to_host(m.state_dict())) for k, m in modules.items()),
+                'optimizers': dict((k, _to_host(o.state_dict())) for k, o in optimizers.items()),
+                }
+        state.update(extra)
+        return state
+
+    def save(self, step, modules, optimizers, **extra):
+        # At most one write is in flight; checkpoints are far enough apart
+        # that this almost never blocks.
+        self.wait()
+        state = self.snapshot(modules, optimizers, step=step, **extra)
+        self._thread = threading.Thread(target=self._write, args=(step, state))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _write(self, step, state):
+        path = checkpoint_path(self.prefix, step)
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                T.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+            self._prune()
+        except Exception as e:
+            self._error = e
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _prune(self):
+        if self.keep <= 0:
+            return
+        for _, path in list_checkpoints(self.prefix)[:-self.keep]:
+            os.remove(path)
+
+
+def load_checkpoint(path, modules, optimizers):
+    '''
+    Loads the checkpoint into the given modules and optimizers in place, so
+    that optimizers already bound to the module parameters stay valid.
+    Returns the whole checkpoint dictionary for reading the extra entries.
+    '''
+    state = T.load(path, map_location=lambda storage, loc: storage)
+    for k, m in modules.items():
+        m.load_state_dict(state['modules'][k])
+    for k, o in optimizers.items():
+        o.load_state_dict(state['optimizers'][k])
+    return state
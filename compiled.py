@@ -0,0 +1,79 @@
+
+# Tracing of the small per-step computations in audiogan.py into graphs, to
+# cut the Python and dispatch overhead which dominates at small batch sizes.
+# Everything falls back to eager execution if tracing is not available in
+# the installed PyTorch, fails, or does not reproduce the eager results.
+
+import torch as T
+import torch.nn as NN
+
+
+def available():
+    return hasattr(T, 'jit') and hasattr(T.jit, 'trace')
+
+
+def _flatten(x):
+    if isinstance(x, (list, tuple)):
+        return sum([_flatten(_x) for _x in x], [])
+    return [x]
+
+
+def _close(a, b, rtol, atol):
+    a = _flatten(a)
+    b = _flatten(b)
+    return len(a) == len(b) and all(
+            x.size() == y.size() and T.allclose(x.data.float(), y.data.float(), rtol, atol)
+            for x, y in zip(a, b))
+
+
+def compile_fn(fn, example_inputs, name, rtol=1e-4, atol=1e-5):
+    '''
+    Returns @fn (a function or a module) traced on @example_inputs, or @fn
+    itself if tracing is not available, fails, or gives different results
+    than @fn on the example.
+
+    Tracing records the operations run on the example, so @fn must not
+    branch on the values of its inputs.
+    '''
+    if not available():
+        print('T.jit.trace is not available, running %s eagerly' % name)
+        return fn
+    try:
+        traced = T.jit.trace(fn, example_inputs)
+        same = _close(traced(*example_inputs), fn(*example_inputs), rtol, atol)
+    except Exception as e:
+        print('Could not trace %s, running it eagerly: %s' % (name, e))
+        return fn
+    if not same:
+        print('Traced %s does not match eager results, running it eagerly' % name)
+        return fn
+    return traced
+
+
+class _Method(NN.Module):
+    '''
+    Exposes a method of @module as forward(), so that it is traced together
+    with the parameters of @module.
+    '''
+    def __init__(self, module, method):
+        NN.Module.__init__(self)
+        self.module = module
+        self.method = method
+
+    def forward(self, *args):
+        return self.method(self.module, *args)
+
+
+def compile_method(module, name, example_inputs, rtol=1e-4, atol=1e-5):
+    '''
+    Replaces the method @name of @module by its traced version, if tracing
+    succeeds.  The traced graph shares the parameters of @module and is not
+    part of its state dict.  Returns whether the method was replaced.
+    '''
+    wrapper = _Method(module, getattr(type(module), name))
+    traced = compile_fn(wrapper, example_inputs, '%s.%s' % (type(module).__name__, name), rtol, atol)
+    if traced is wrapper:
+        return False
+    # Bypass NN.Module.__setattr__, which would register it as a submodule
+    module.__dict__[name] = traced
+    return True
@@ -1,42 +1,286 @@
 
+import os
+import time
+import zipfile
+from collections import OrderedDict
+
 import h5py
 import numpy.random as RNG
 import numpy as NP
 import utiltf as util
+import storage
+
+class IndexStream(object):
+    '''
+    Endless stream of batches of indices in [lower, upper), visiting every
+    index exactly once per epoch in random order.
+
+    The permutation of each epoch is drawn from @seed and the epoch number,
+    so the stream can be saved with state() and resumed with
+    IndexStream(..., **state).  Indices which the batch crossing an epoch
+    boundary already took from the old epoch are deferred to the end of the
+    new one, so a batch never holds the same index twice.
+    '''
+    def __init__(self, lower, upper, batch_size, seed=None, epoch=1, position=0, deferred=()):
+        self.lower = lower
+        self.upper = upper
+        self.batch_size = batch_size
+        self.seed = seed if seed is not None else RNG.randint(2 ** 31)
+        self.epoch = epoch
+        self.position = position
+        self.deferred = NP.asarray(deferred, dtype=NP.int64)
+        self._perm = self._permutation()
+
+    def _permutation(self):
+        rng = NP.random.RandomState((self.seed + self.epoch) % 2 ** 32)
+        perm = self.lower + rng.permutation(self.upper - self.lower)
+        if len(self.deferred) > 0:
+            taken = NP.in1d(perm, self.deferred)
+            perm = NP.concatenate([perm[~taken], perm[taken]])
+        return perm
+
+    def state(self):
+        return {'seed': self.seed, 'epoch': self.epoch, 'position': self.position, 'deferred': self.deferred.tolist()}
+
+    def next(self):
+        '''
+        Returns the epoch of the batch (that of its last index) and its
+        indices.
+        '''
+        indices = self._perm[self.position:self.position + self.batch_size]
+        self.position += len(indices)
+        while len(indices) < self.batch_size:
+            self.epoch += 1
+            self.deferred = indices
+            self._perm = self._permutation()
+            more = self._perm[:self.batch_size - len(indices)]
+            self.position = len(more)
+            indices = NP.concatenate([indices, more])
+        return self.epoch, indices
+
+    __next__ = next
+
+
+def read_rows(data, indices, ncols=None):
+    '''
+    Reads the rows of an HDF5 dataset or an array (e.g. a memmap) at the
+    sorted @indices, with one read per run of consecutive indices, and only
+    the first @ncols columns if given.
+    '''
+    if hasattr(data, 'read_rows'):
+        return data.read_rows(indices, ncols)
+    indices = NP.asarray(indices)
+    ncols = data.shape[1] if ncols is None else min(ncols, data.shape[1])
+    out = NP.empty((len(indices), ncols) + tuple(data.shape[2:]), dtype=data.dtype)
+    breaks = NP.flatnonzero(NP.diff(indices) != 1) + 1
+    starts = NP.concatenate([[0], breaks])
+    ends = NP.concatenate([breaks, [len(indices)]])
+    for start, end in zip(starts, ends):
+        source = NP.s_[indices[start]:indices[end - 1] + 1, :ncols]
+        if hasattr(data, 'read_direct'):
+            data.read_direct(out, source, NP.s_[start:end])
+        else:
+            out[start:end] = data[source]
+    return out
+
+class SubsetView(object):
+    '''
+    Lazy view of the sorted @rows of @data, read on demand with read_rows().
+    Up to @cache_rows rows read recently are kept in memory (least recently
+    used first out); 0 disables the cache.
+    '''
+    def __init__(self, data, rows, cache_rows=0):
+        self.data = data
+        self.rows = NP.sort(NP.asarray(rows))
+        self.shape = (len(self.rows),) + tuple(data.shape[1:])
+        self.dtype = data.dtype
+        self.cache_rows = cache_rows
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read_rows(self, indices, ncols=None):
+        rows = self.rows[NP.asarray(indices)]
+        if self.cache_rows == 0:
+            return read_rows(self.data, rows, ncols)
+
+        out = [self._cache.pop((r, ncols), None) for r in rows]
+        missing = [i for i, row in enumerate(out) if row is None]
+        if len(missing) > 0:
+            for i, row in zip(missing, read_rows(self.data, rows[missing], ncols)):
+                # Copied, so that cached rows do not pin the whole block read
+                out[i] = row.copy()
+        for r, row in zip(rows, out):
+            # Re-inserting moves the row to the most recently used end
+            self._cache[(r, ncols)] = row
+        while len(self._cache) > self.cache_rows:
+            self._cache.popitem(last=False)
+        return NP.array(out)
+
+class UnconditionalLoader(object):
+    '''
+    Iterator over unconditional batches of the rows [lower, upper) of @data,
+    drawn by an IndexStream.  state() returns the position after the last
+    batch, and UnconditionalLoader(..., state=state) resumes from there.
+    '''
+    def __init__(self, batch_size, data, lower, upper, args, seed=None, fmt=None, state=None):
+        self.data = data
+        self.amplitudes = args.amplitudes
+        self.fmt = fmt if fmt is not None else storage.Storage()
+        if state is not None:
+            state = dict(state)
+            self.batch = state.pop('batch')
+            self.stream = IndexStream(lower, upper, batch_size, **state)
+        else:
+            self.batch = 0
+            self.stream = IndexStream(lower, upper, batch_size, seed)
+        self.epoch = self.stream.epoch
+
+    def __iter__(self):
+        return self
+
+    def state(self):
+        return dict(self.stream.state(), batch=self.batch)
 
-def _unconditional_dataloader(batch_size, data, lower, upper, args):
-    epoch = 1
+    def next(self):
+        epoch, indices = self.stream.next()
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.batch = 0
+        sample = self.fmt.decode(read_rows(self.data, NP.sort(indices), self.amplitudes))
+        self.batch += 1
+        return [self.epoch, self.batch - 1, sample] + [None] * 6
+
+    __next__ = next
+
+class CropSampler(object):
+    '''
+    Draws fixed-size windows at random aligned positions of utterances which
+    are stored once, back to back, in @audio.
+
+    starts, ends: bounds of the utterances to draw from in @audio
+    window: number of amplitudes of each window
+    align: windows start at multiples of this many amplitudes from the start
+           of their utterance
+    threshold: a window is kept only if more than half of its amplitudes
+           exceed this in absolute value
+    fmt: storage.Storage of @audio
+    '''
+    def __init__(self, audio, starts, ends, window, align=1, threshold=0., fmt=None):
+        self.audio = audio
+        self.starts = NP.asarray(starts, dtype=NP.int64)
+        self.window = window
+        self.align = align
+        self.threshold = threshold
+        self.fmt = fmt if fmt is not None else storage.Storage()
+        lengths = NP.asarray(ends, dtype=NP.int64) - self.starts
+        self.nwindows = NP.maximum((lengths - window) // align + 1, 0)
+        if self.nwindows.sum() == 0:
+            raise ValueError('no utterance is long enough for a window of %d amplitudes' % window)
+        # Utterances are drawn in proportion to their number of windows, so
+        # that every window is equally likely.
+        self.prob, self.alias = alias_table(self.nwindows)
+
+    def __len__(self):
+        return int(self.nwindows.sum())
+
+    def draw(self, n):
+        '''
+        Start positions in @audio of @n uniformly drawn windows.
+        '''
+        i = RNG.randint(len(self.nwindows), size=n)
+        utterances = NP.where(RNG.random_sample(n) < self.prob[i], i, self.alias[i])
+        windows = (RNG.random_sample(n) * self.nwindows[utterances]).astype(NP.int64)
+        return self.starts[utterances] + windows * self.align
+
+    def read(self, starts):
+        out = NP.empty((len(starts), self.window), dtype=NP.float32)
+        # Read in the order of the file
+        for i in NP.argsort(starts):
+            self.fmt.decode(self.audio[starts[i]:starts[i] + self.window], out=out[i])
+        return out
+
+    def sample(self, n, max_tries=100):
+        '''
+        Returns @n windows which pass the energy threshold.  The check runs
+        on all windows of a draw at once, and only the rejected rows are
+        drawn again.
+        '''
+        out = NP.empty((n, self.window), dtype=NP.float32)
+        pending = NP.arange(n)
+        for _ in range(max_tries):
+            windows = self.read(self.draw(len(pending)))
+            accepted = (NP.abs(windows) > self.threshold).sum(1) > self.window / 2.
+            out[pending[accepted]] = windows[accepted]
+            pending = pending[~accepted]
+            if len(pending) == 0:
+                return out
+        raise RuntimeError('%d windows out of %d are still below the energy threshold after %d draws' %
+                           (len(pending), n, max_tries))
+
+def _crop_dataloader(batch_size, sampler):
+    epoch = 0
     batch = 0
-    idx = RNG.permutation(range(lower, upper))
-    cur = 0
+    drawn = 0
 
     while True:
-        indices = []
-        for i in range(batch_size):
-            if cur == len(idx):
-                cur = 0
-                idx_set = list(set(range(lower, upper)) - set(indices))
-                idx = RNG.permutation(idx_set)
-                epoch += 1
-                batch = 0
-            indices.append(idx[cur])
-            cur += 1
-        sample = data[sorted(indices)]
-        yield [epoch, batch, NP.array(sample)[:, :args.amplitudes]] + [None] * 6
+        yield [epoch, batch, sampler.sample(batch_size)] + [None] * 6
         batch += 1
+        drawn += batch_size
+        # An epoch is as many windows as there are in the utterances
+        if drawn >= len(sampler):
+            epoch += 1
+            batch = 0
+            drawn -= len(sampler)
+
+def crop_dataloader(batch_size, dataset, args):
+    '''
+    Unconditional data loaders over a dataset of whole utterances, as
+    written by preprocess.py.  --subset selects utterances.
+    '''
+    offsets = dataset['offsets'][:]
+    starts = offsets[:-1]
+    ends = offsets[1:]
+    if args.subset:
+        subset = RNG.permutation(len(starts))[:args.subset]
+        starts = starts[subset]
+        ends = ends[subset]
+    n_train = len(starts) // 10 * 9
 
-def unconditional_dataloader(batch_size, args):
+    threshold = getattr(args, 'crop_threshold', None)
+    if threshold is None:
+        threshold = dataset.attrs.get('threshold', 0.)
+    align = getattr(args, 'crop_align', 1)
+    fmt = storage.Storage.of(dataset)
+    sampler = CropSampler(dataset['audio'], starts[:n_train], ends[:n_train], args.amplitudes, align, threshold, fmt)
+    sampler_val = CropSampler(dataset['audio'], starts[n_train:], ends[n_train:], args.amplitudes, align, threshold, fmt)
+
+    return None, _crop_dataloader(batch_size, sampler), _crop_dataloader(batch_size, sampler_val)
+
+def unconditional_dataloader(batch_size, args, state=None, state_val=None):
+    '''
+    Unconditional data loaders.  Over datasets of precomputed windows they
+    are UnconditionalLoaders, seeded from --seed and resumed from @state and
+    @state_val if given.  Windows cropped from whole utterances are drawn
+    from the global NumPy RNG and cannot be resumed.
+    '''
     dataset = h5py.File(args.dataset)
+    if 'audio' in dataset:
+        return crop_dataloader(batch_size, dataset, args)
+    # Datasets of precomputed windows
     data = dataset['data']
     nsamples = data.shape[0]
     if args.subset:
-        nsample_indices = RNG.permutation(range(nsamples))[:args.subset]
-        data = data[sorted(nsample_indices)]
-        nsamples = args.subset
+        nsample_indices = RNG.permutation(nsamples)[:args.subset]
+        data = SubsetView(data, nsample_indices, getattr(args, 'subset_cache', 0))
+        nsamples = len(data)
     n_train_samples = nsamples // 10 * 9
 
-    dataloader = _unconditional_dataloader(batch_size, data, 0, n_train_samples, args)
-    dataloader_val = _unconditional_dataloader(batch_size, data, n_train_samples, nsamples, args)
+    seed = getattr(args, 'seed', None)
+    fmt = storage.Storage.of(dataset)
+    dataloader = UnconditionalLoader(batch_size, data, 0, n_train_samples, args, seed, fmt, state)
+    dataloader_val = UnconditionalLoader(batch_size, data, n_train_samples, nsamples, args, seed, fmt, state_val)
 
     return None, dataloader, dataloader_val
 
@@ -45,74 +289,384 @@ def word_to_seq(word, maxcharlen):
     char_seq[:len(word)] = [ord(c) for c in word]
     return char_seq
 
-def _pick_sample_from_word(key, maxlen, dataset, frame_size=None, skip_samples=False):
-    sample_idx = RNG.choice(dataset[key].shape[0])
-    sample_out = NP.zeros(maxlen)
-    length = 0
+def encode_words(words, maxcharlen=None):
+    '''
+    Character codes of all @words at once, as a (len(words), maxcharlen)
+    int32 array padded with zeros, together with the word lengths.
+    '''
+    words = NP.asarray(words, dtype=NP.unicode_)
+    lengths = NP.char.str_len(words).astype(NP.int64)
+    width = max(words.dtype.itemsize // 4, 1)
+    codes = NP.ascontiguousarray(words).view(NP.uint32).reshape(len(words), width)
+    if maxcharlen is None:
+        maxcharlen = lengths.max() if len(words) > 0 else 0
+    seqs = NP.zeros((len(words), maxcharlen), dtype=NP.int32)
+    n = min(width, maxcharlen)
+    seqs[:, :n] = codes[:, :n]
+    return seqs, lengths
+
+class WordBatch(object):
+    '''
+    Preallocated arrays of a conditional batch, which pick_words() refills in
+    place.  Anything kept beyond the next refill has to be copied.
+    '''
+    def __init__(self, batch_size, maxlen, maxcharlen):
+        self.keys = NP.empty(batch_size, dtype=object)
+        self.cseq = NP.zeros((batch_size, maxcharlen), dtype=NP.int32)
+        self.clen = NP.zeros(batch_size, dtype=NP.int64)
+        self.samples = NP.zeros((batch_size, maxlen), dtype=NP.float32)
+        self.lengths = NP.zeros(batch_size, dtype=NP.int64)
+
+    def fields(self):
+        return [self.keys, self.cseq, self.clen, self.samples, self.lengths]
+
+def _pick_sample_from_word(key, sample_idx, sample_len, gain, dataset, fmt, out, frame_size=None):
+    '''
+    Reads the first @sample_len amplitudes of the sample into @out,
+    dequantized from the storage format @fmt and scaled by @gain in the same
+    pass, and returns its length.
+    '''
+    length = sample_len if frame_size is None else util.roundup(sample_len, frame_size)
+
+    fmt.decode(dataset[key][sample_idx, :sample_len], out=out[:sample_len], gain=gain)
+    out[sample_len:] = 0
+    return length
+
+def pick_words(batch_size, maxlen, dataset, sampler, maxcharlen, args, frame_size=None, skip_samples=False, out=None,
+               fmt=None):
+    '''
+    Draws a batch of words from @sampler, with a sample of each unless
+    @skip_samples, into the WordBatch @out (a new one if None).  Returns
+    [keys, cseq, clen, samples, lengths].
+
+    fmt: storage.Storage of @dataset, read from the file if None
+    '''
+    batch = out if out is not None else WordBatch(batch_size, maxlen, maxcharlen)
+    words, sample_idx, sample_len, gains = sampler.draw(batch_size)
     if not skip_samples:
-        sample_in = dataset[key][sample_idx]
-        sample_len = sum(1 - NP.cumprod((sample_in == 0)[::-1]))
-        if sample_len > maxlen:
-            return None, None
-        length = sample_len if frame_size is None else util.roundup(sample_len, frame_size)
+        fmt = fmt if fmt is not None else storage.Storage.of(dataset)
+        for i in range(batch_size):
+            batch.lengths[i] = _pick_sample_from_word(
+                    sampler.keys[words[i]], sample_idx[i], sample_len[i], gains[i], dataset, fmt,
+                    batch.samples[i], frame_size)
 
-        sample_out[:sample_len] = sample_in[:sample_len]
-    return sample_out, length
+    batch.keys[:] = sampler.keys[words]
+    batch.cseq[:, :sampler.seqs.shape[1]] = sampler.seqs[words]
+    batch.clen[:] = sampler.lengths[words]
+    return batch.fields()
 
-def pick_word(maxlen, dataset, keys, maxcharlen, args, frame_size=None, skip_samples=False):
-    while True:
-        key = RNG.choice(keys)
-        sample_out, length = _pick_sample_from_word(key, maxlen, dataset, frame_size, skip_samples)
-        if sample_out is not None:
-            if not skip_samples:
-                maxabs = NP.abs(sample_out).max()
-                if maxabs == 0:
-                    continue
-                sample_out /= maxabs
-            break
-
-    return key, word_to_seq(key, maxcharlen), len(key), sample_out, length
-
-def pick_words(batch_size, maxlen, dataset, keys, maxcharlen, args, frame_size=None, skip_samples=False):
-    return [NP.array(a) for a in zip(*(pick_word(maxlen, dataset, keys, maxcharlen, args, frame_size, skip_samples) for _ in range(batch_size)))]
-
-def _conditional_dataloader(batch_size, dataset, maxlen, keys, args, frame_size=None):
+def _conditional_dataloader(batch_size, dataset, maxlen, sampler, args, frame_size=None, pool=None):
+    '''
+    pool: optional bufferpool.BufferPool to take the sample array of each
+          batch from, instead of refilling the same one
+    '''
     epoch = 0
     batch = 0
-    maxcharlen = max(len(k) for k in keys)
+    maxcharlen = sampler.seqs.shape[1]
+    fmt = storage.Storage.of(dataset)
 
     if frame_size is not None:
         maxlen = util.roundup(maxlen, frame_size)
+    # Refilled by every batch; consumers that keep a batch copy it
+    out = WordBatch(batch_size, maxlen, maxcharlen)
     while True:
-        samples = []
         batch += 1
-        i = 0
-        picked_keys, cseq, clen, samples, lengths = pick_words(batch_size, maxlen, dataset, keys, maxcharlen, args, frame_size)
+        if pool is not None:
+            out.samples = pool.acquire(out.samples.shape)
+        picked_keys, cseq, clen, samples, lengths = pick_words(
+                batch_size, maxlen, dataset, sampler, maxcharlen, args, frame_size, out=out, fmt=fmt)
         yield [epoch, batch, samples, lengths, picked_keys, cseq, clen]
 
+def effective_lengths(rows):
+    '''
+    Length of each row of a 2D array up to its last nonzero amplitude.
+    '''
+    nonzero = rows != 0
+    trailing = NP.argmax(nonzero[:, ::-1], axis=1)
+    return NP.where(nonzero.any(1), rows.shape[1] - trailing, 0)
+
+# Group of the HDF5 file holding the speaker id of every sample of each word,
+# as written by preprocess-fisher.py
+SPEAKERS = '_speakers'
+
+class DatasetIndex(object):
+    '''
+    Per-word metadata of a conditional dataset, so that opening it does not
+    have to touch every per-word HDF5 dataset.
+
+    keys: the word keys, in the order of the HDF5 file
+    counts: number of samples of each word
+    widths: padded width of each word's samples
+    offsets: start of each word's entries in the per-sample arrays
+    lengths: effective length of every sample (see effective_lengths())
+    peaks: peak absolute amplitude of every sample
+    rms: root mean square amplitude of every sample within its length
+    speakers: speaker id of every sample, or -1 if the dataset has none
+    '''
+    VERSION = 2
+
+    def __init__(self, keys, counts, widths, lengths, peaks, rms, speakers):
+        self.keys = NP.asarray(keys)
+        self.counts = NP.asarray(counts, dtype=NP.int64)
+        self.widths = NP.asarray(widths, dtype=NP.int64)
+        self.offsets = NP.concatenate([[0], NP.cumsum(self.counts)[:-1]]).astype(NP.int64)
+        self.lengths = NP.asarray(lengths, dtype=NP.int64)
+        self.peaks = NP.asarray(peaks, dtype=NP.float32)
+        self.rms = NP.asarray(rms, dtype=NP.float32)
+        self.speakers = NP.asarray(speakers, dtype=NP.int64)
+        self.position = dict((k, i) for i, k in enumerate(self.keys))
+
+    @classmethod
+    def build(cls, h5):
+        keys = [k for k in h5.keys() if k != SPEAKERS]
+        fmt = storage.Storage.of(h5)
+        counts = []
+        widths = []
+        lengths = []
+        peaks = []
+        rms = []
+        speakers = []
+        for k in keys:
+            data = h5[k]
+            rows = data[:]
+            # Zero amplitudes are zero codes, so lengths can be taken on the
+            # stored rows
+            l = effective_lengths(rows)
+            rows = fmt.decode(rows)
+            counts.append(data.shape[0])
+            widths.append(data.shape[1])
+            lengths.append(l)
+            peaks.append(NP.abs(rows).max(1) if rows.shape[1] > 0 else NP.zeros(rows.shape[0]))
+            rms.append(NP.sqrt((rows.astype(NP.float64) ** 2).sum(1) / NP.maximum(l, 1)))
+            if SPEAKERS in h5 and k in h5[SPEAKERS]:
+                speakers.append(h5[SPEAKERS][k][:, 0].astype(NP.int64))
+            else:
+                speakers.append(-NP.ones(data.shape[0], dtype=NP.int64))
+        per_sample = [NP.concatenate(a) if len(a) > 0 else NP.zeros(0) for a in [lengths, peaks, rms, speakers]]
+        return cls(keys, counts, widths, *per_sample)
+
+    def save(self, path, source_stat):
+        # Written under a name of this process and renamed into place, so
+        # that readers never see a partial index.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                NP.savez(f, version=self.VERSION, keys=self.keys, counts=self.counts, widths=self.widths,
+                         lengths=self.lengths, peaks=self.peaks, rms=self.rms, speakers=self.speakers,
+                         source_mtime=source_stat.st_mtime, source_size=source_stat.st_size)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path, source_stat):
+        '''
+        Returns None if the index at @path is missing, unreadable, of another
+        version or does not match the dataset with the given os.stat() result.
+        '''
+        if not os.path.exists(path):
+            return None
+        try:
+            with NP.load(path) as f:
+                if (f['version'] != cls.VERSION or
+                        f['source_mtime'] != source_stat.st_mtime or f['source_size'] != source_stat.st_size):
+                    return None
+                return cls(f['keys'], f['counts'], f['widths'], f['lengths'], f['peaks'], f['rms'], f['speakers'])
+        except (IOError, OSError, KeyError, ValueError, zipfile.BadZipfile) as e:
+            print 'Ignoring unreadable index %s: %s' % (path, e)
+            return None
+
+    def samples(self, key):
+        '''
+        Slice of the per-sample arrays holding the samples of @key.
+        '''
+        i = self.position[key]
+        return slice(self.offsets[i], self.offsets[i] + self.counts[i])
+
+NORMALIZATIONS = ['peak', 'rms', 'speaker', 'none']
+
+def normalization_gains(index, mode='peak', target_rms=0.1):
+    '''
+    Gain of every sample of @index:
+    'peak' scales each sample to a peak amplitude of 1, 'rms' scales each
+    sample to an RMS amplitude of @target_rms, 'speaker' scales all samples
+    of a speaker by the same gain so that their overall RMS amplitude is
+    @target_rms, and 'none' keeps the stored amplitudes.
+    Silent samples get a gain of 0.
+    '''
+    with NP.errstate(divide='ignore', invalid='ignore'):
+        if mode == 'none':
+            gains = NP.ones(len(index.lengths))
+        elif mode == 'peak':
+            gains = 1. / index.peaks
+        elif mode == 'rms':
+            gains = target_rms / index.rms
+        elif mode == 'speaker':
+            if (index.speakers < 0).any():
+                raise ValueError('speaker normalization needs the speaker of every sample (see preprocess-fisher.py)')
+            energy = NP.bincount(index.speakers, weights=index.rms.astype(NP.float64) ** 2 * index.lengths)
+            total = NP.bincount(index.speakers, weights=index.lengths)
+            gains = target_rms / NP.sqrt(energy / total)[index.speakers]
+        else:
+            raise ValueError('unknown normalization %s' % mode)
+    gains[~NP.isfinite(gains)] = 0
+    return gains.astype(NP.float32)
+
+def index_path(path):
+    return path + '.index.npz'
+
+def load_index(path, h5, build=True, timeout=600):
+    '''
+    Loads the sidecar index of the dataset at @path, building and saving it
+    first if it is missing or out of date.
+
+    build: if False, wait up to @timeout seconds for another process (e.g.
+           rank 0 of a distributed run) to save the index before building
+           it here
+    '''
+    stat = os.stat(path)
+    index = DatasetIndex.load(index_path(path), stat)
+    if index is None and not build:
+        print 'Waiting for the index of %s...' % path
+        deadline = time.time() + timeout
+        while index is None and time.time() < deadline:
+            time.sleep(1)
+            index = DatasetIndex.load(index_path(path), stat)
+    if index is None:
+        print 'Indexing %s...' % path
+        index = DatasetIndex.build(h5)
+        try:
+            index.save(index_path(path), stat)
+        except (IOError, OSError) as e:
+            print 'Could not save index: %s' % e
+    return index
+
+def alias_table(weights):
+    '''
+    Builds the tables of Vose's alias method for drawing from the discrete
+    distribution proportional to @weights in constant time.
+    '''
+    n = len(weights)
+    prob = NP.asarray(weights, dtype=NP.float64) * n / NP.sum(weights)
+    alias = NP.arange(n)
+    small = list(NP.flatnonzero(prob < 1))
+    large = list(NP.flatnonzero(prob >= 1))
+    while len(small) > 0 and len(large) > 0:
+        s = small.pop()
+        l = large.pop()
+        alias[s] = l
+        prob[l] -= 1 - prob[s]
+        (small if prob[l] < 1 else large).append(l)
+    # Whatever is left is 1 up to rounding errors
+    prob[small + large] = 1
+    return prob, alias
+
+class WordSampler(object):
+    '''
+    Draws (word, sample index) pairs from a set of words with precomputed
+    alias tables, so that a batch takes one vectorized draw and no access to
+    the HDF5 file.
+
+    samples: for every word, the indices of the samples to draw from, e.g.
+          only those which fit into the batch
+    sample_lengths: for every word, the effective lengths of those samples
+    sample_gains: for every word, the normalization gains of those samples
+    mode: 'word' draws words uniformly, 'sample' draws samples uniformly
+          (i.e. words in proportion to their number of samples), and
+          'smoothed' draws words in proportion to their number of samples
+          to the power of 1 / @temperature
+    Iterating over a sampler gives its words.  The character sequences of
+    all words are encoded once into self.seqs and self.lengths.
+    '''
+    MODES = ['word', 'sample', 'smoothed']
+
+    def __init__(self, keys, samples, sample_lengths, sample_gains, mode='word', temperature=1.):
+        self.keys = NP.asarray(keys)
+        self.counts = NP.array([len(s) for s in samples], dtype=NP.int64)
+        self.offsets = NP.concatenate([[0], NP.cumsum(self.counts)[:-1]]).astype(NP.int64)
+        self.sample_indices = NP.concatenate([NP.zeros(0, dtype=NP.int64)] + list(samples)).astype(NP.int64)
+        self.sample_lengths = NP.concatenate([NP.zeros(0, dtype=NP.int64)] + list(sample_lengths)).astype(NP.int64)
+        self.sample_gains = NP.concatenate([NP.zeros(0, dtype=NP.float32)] + list(sample_gains)).astype(NP.float32)
+        if mode == 'word':
+            weights = (self.counts > 0).astype(NP.float64)
+        elif mode == 'sample':
+            weights = self.counts.astype(NP.float64)
+        elif mode == 'smoothed':
+            weights = self.counts.astype(NP.float64) ** (1. / temperature)
+        else:
+            raise ValueError('unknown sampling mode %s' % mode)
+        self.prob, self.alias = alias_table(weights)
+        self.seqs, self.lengths = encode_words(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def draw(self, n):
+        '''
+        Returns the positions in self.keys of @n words, and the index,
+        length and gain of a uniformly drawn sample of each.
+        '''
+        i = RNG.randint(len(self.keys), size=n)
+        words = NP.where(RNG.random_sample(n) < self.prob[i], i, self.alias[i])
+        j = self.offsets[words] + (RNG.random_sample(n) * self.counts[words]).astype(NP.int64)
+        return words, self.sample_indices[j], self.sample_lengths[j], self.sample_gains[j]
+
 def _valid_keys(keys, args):
-    keys = [k for k in keys if not (k[-1] == '-' or k[0] == '(')]
-    keys = [k for k in keys if len(k) >= args.minwordlen]
-    return keys
+    keys = NP.asarray(keys)
+    if len(keys) == 0:
+        return keys
+    valid = ~(NP.char.endswith(keys, '-') | NP.char.startswith(keys, '('))
+    valid &= NP.char.str_len(keys) >= args.minwordlen
+    return keys[valid]
 
-def conditional_dataloader(batch_size, args, maxlen=None, frame_size=None):
+def conditional_dataloader(batch_size, args, maxlen=None, frame_size=None, pool=None):
     dataset = h5py.File(args.dataset)
-    keys = _valid_keys(dataset.keys(), args)
+    # Only the first process of a distributed run builds a missing index
+    index = load_index(args.dataset, dataset, build=getattr(args, 'rank', 0) == 0)
+    keys = _valid_keys(index.keys, args)
+    maxlen = maxlen or index.widths[NP.in1d(index.keys, keys)].max()
+
+    # Only samples which fit into a batch and are not silent are drawn, so
+    # that batches never have to be redrawn.
+    limit = maxlen if frame_size is None else util.roundup(maxlen, frame_size)
+    eligible = (index.lengths > 0) & (index.lengths <= limit)
+    samples = dict((k, NP.flatnonzero(eligible[index.samples(k)])) for k in keys)
+    n_samples = sum(index.counts[index.position[k]] for k in keys)
+    keys = [k for k in keys if len(samples[k]) > 0]
+    print '%d of %d samples eligible (at most %d amplitudes and not silent), %d words' % (
+            sum(len(samples[k]) for k in keys), n_samples, limit, len(keys))
     keys = list(RNG.permutation(keys))
     n_train_keys = len(keys) // 10 * 9
-    maxlen = maxlen or max(dataset[k].shape[1] for k in keys)
+
+    gains = normalization_gains(index, getattr(args, 'normalize', 'peak'), getattr(args, 'normalize_rms', 0.1))
+
+    def sampler(keys):
+        return WordSampler(
+                keys,
+                [samples[k] for k in keys],
+                [index.lengths[index.samples(k)][samples[k]] for k in keys],
+                [gains[index.samples(k)][samples[k]] for k in keys],
+                getattr(args, 'word_sampling', 'word'), getattr(args, 'word_temperature', 1.))
+    sampler_train = sampler(keys[:n_train_keys])
+    sampler_val = sampler(keys[n_train_keys:])
 
     dataloader = _conditional_dataloader(
-            batch_size, dataset, maxlen, keys[:n_train_keys], args, frame_size)
+            batch_size, dataset, maxlen, sampler_train, args, frame_size, pool)
     dataloader_val = _conditional_dataloader(
-            batch_size, dataset, maxlen, keys[n_train_keys:], args, frame_size)
+            batch_size, dataset, maxlen, sampler_val, args, frame_size)
 
-    return dataset, maxlen, dataloader, dataloader_val, keys[:n_train_keys], keys[n_train_keys:]
+    return dataset, maxlen, dataloader, dataloader_val, sampler_train, sampler_val
 
-def dataloader(batch_size, args, maxlen=None, frame_size=None):
+def dataloader(batch_size, args, maxlen=None, frame_size=None, pool=None):
     # Returns a generator which returns
     # (epoch, batch, audio, word, char_seq, char_seq_len, word_wrong, char_seq_wrong, char_seq_wrong_len)
     if not args.conditional:
         return unconditional_dataloader(batch_size, args)
     else:
-        return conditional_dataloader(batch_size, args, maxlen=maxlen, frame_size=frame_size)
+        return conditional_dataloader(batch_size, args, maxlen=maxlen, frame_size=frame_size, pool=pool)
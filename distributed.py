@@ -0,0 +1,76 @@
+
+# Data-parallel training across processes.
+#
+# Every process holds a full replica of the models and trains on its own
+# shard of the batch; gradients are averaged with one all-reduce per
+# optimizer step.  Launch one process per rank, e.g. on a single machine
+# with 4 cores each:
+#
+# for i in 0 1 2 3; do
+#     python audiogan.py --world_size 4 --rank $i --dist_url tcp://127.0.0.1:23456 --threads 4 ... &
+# done
+#
+# The gloo backend works on CPU-only machines and across nodes.
+# On GPU machines rank i uses device i % (number of GPUs), so launch one
+# process per GPU to use all of them.
+
+import torch as T
+import torch.distributed as dist
+
+
+def init(backend, init_method, world_size, rank):
+    dist.init_process_group(backend, init_method=init_method, world_size=world_size, rank=rank)
+
+
+def broadcast_parameters(modules, src=0):
+    '''
+    Makes the parameters and buffers of every replica identical to those of
+    @src.
+    '''
+    for m in modules:
+        for t in m.state_dict().values():
+            dist.broadcast(t, src)
+
+
+def _flatten(tensors):
+    return T.cat([t.contiguous().view(-1) for t in tensors])
+
+
+def _unflatten_into(flat, tensors):
+    offset = 0
+    for t in tensors:
+        n = t.numel()
+        t.copy_(flat[offset:offset + n].view_as(t))
+        offset += n
+
+
+def allreduce_grads(params, world_size):
+    '''
+    Averages the gradients of @params over all processes with a single
+    all-reduce on a flattened buffer.  All processes must have gradients for
+    the same parameters, which holds as long as they run the same code path.
+    '''
+    grads = [p.grad.data for p in params if p.grad is not None]
+    if len(grads) == 0:
+        return
+    flat = _flatten(grads)
+    dist.all_reduce(flat)
+    flat /= world_size
+    _unflatten_into(flat, grads)
+
+
+def allreduce_sum(values):
+    '''
+    Sums a list of Python numbers over all processes.
+    '''
+    t = T.DoubleTensor([float(v) for v in values])
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+class NullWriter(object):
+    '''
+    Stand-in for the Tensorboard writer on processes other than rank 0.
+    '''
+    def add_summary(self, *args, **kwargs):
+        pass
@@ -0,0 +1,205 @@
+
+# Periodic evaluation of the latest checkpoint on a fixed evaluation set.
+#
+# The evaluation set (validation words, their real samples and the noise to
+# generate from) is drawn once at startup.  An Evaluator thread watches for
+# new checkpoints, loads each into its own copy of the models, and writes
+# discriminator accuracies and spectral distances to Tensorboard, so the
+# training loop never waits for it.
+
+import threading
+
+import numpy as NP
+import torch as T
+import tensorflow as TF     # for Tensorboard
+
+import checkpoint
+
+
+def no_grad():
+    if hasattr(T, 'no_grad'):
+        return T.no_grad()
+    return _NullContext()
+
+
+class _NullContext(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def log_spectrum(samples, lengths, n_fft=512):
+    '''
+    Returns the log power spectrum of each sample in a (batch, maxlen) array,
+    averaged over Hann-windowed frames of @n_fft amplitudes with half overlap
+    within its length.
+    '''
+    window = NP.hanning(n_fft)
+    hop = n_fft // 2
+    spectra = NP.zeros((samples.shape[0], n_fft // 2 + 1))
+    for i in range(samples.shape[0]):
+        x = samples[i, :max(lengths[i], n_fft)]
+        if x.shape[0] < n_fft:
+            x = NP.pad(x, (0, n_fft - x.shape[0]), 'constant')
+        nframes = 1 + (x.shape[0] - n_fft) // hop
+        idx = NP.arange(n_fft)[NP.newaxis] + hop * NP.arange(nframes)[:, NP.newaxis]
+        power = NP.abs(NP.fft.rfft(x[idx] * window, axis=1)) ** 2
+        spectra[i] = NP.log10(power.mean(0) + 1e-10)
+    return spectra
+
+
+def log_spectral_distance(a, b):
+    '''
+    Root mean square difference in dB between two sets of log spectra, per
+    pair of rows.
+    '''
+    return NP.sqrt(((10 * (a - b)) ** 2).mean(1))
+
+
+class EvalSet(object):
+    '''
+    A fixed set of validation batches with the noise to generate from them.
+
+    batches: list of (samples, lengths, words, cseq, clen) as drawn from the
+            validation data loader
+    '''
+    def __init__(self, batches, nframes, noise_size, seed=0):
+        rng = NP.random.RandomState(seed)
+        self.batches = batches
+        self.z = [rng.randn(len(b[2]), nframes, noise_size).astype(NP.float32) for b in batches]
+        self.real_spectra = [log_spectrum(b[0], b[1]) for b in batches]
+
+    @classmethod
+    def from_loader(cls, first, loader, nbatches, nframes, noise_size, seed=0):
+        '''
+        first: a batch already drawn from @loader, which is included
+        '''
+        batches = [first]
+        while len(batches) < nbatches:
+            # The loader refills its batch arrays, so they are copied
+            _, _, samples, lengths, words, cseq, clen = loader.next()
+            batches.append(tuple(a.copy() for a in (samples, lengths, words, cseq, clen)))
+        return cls(batches, nframes, noise_size, seed)
+
+
+def to_variable(array, like, dtype=NP.float32):
+    '''
+    Input variable for computations under no_grad(), on the device of the
+    tensor @like.  Without T.no_grad (PyTorch 0.3), the variable is volatile
+    instead, so that no graph is built from it.
+    '''
+    t = T.from_numpy(NP.ascontiguousarray(array, dtype=dtype))
+    if like.is_cuda:
+        t = t.cuda()
+    if hasattr(T, 'no_grad'):
+        return T.autograd.Variable(t)
+    return T.autograd.Variable(t, volatile=True)
+
+
+def _frame_accuracy(cls, nframes, real):
+    weight = NP.arange(cls.shape[1])[NP.newaxis] < nframes[:, NP.newaxis]
+    correct = (cls > 0) if real else (cls < 0)
+    return (correct * weight).sum(), weight.sum()
+
+
+def evaluate(models, evalset):
+    '''
+    Runs @models (a dict with 'gen', 'dis', 'eg' and 'ed') on @evalset and
+    returns a dictionary of metrics and the generated samples of each batch
+    as (samples, lengths).
+    '''
+    g, d, e_g, e_d = models['gen'], models['dis'], models['eg'], models['ed']
+    like = next(d.parameters()).data
+    correct_real = total_real = correct_fake = total_fake = 0
+    distances = []
+    length_errors = []
+    generated = []
+    with no_grad():
+        for (samples, lengths, _, cseq, clen), z, real_spectra in zip(
+                evalset.batches, evalset.z, evalset.real_spectra):
+            cseq = to_variable(cseq, like, NP.int64)
+            clen = to_variable(clen, like, NP.int64)
+            fake, _, _, fake_len = g(z=to_variable(z, like), c=e_g(cseq, clen))
+            fake = fake.data.cpu().numpy()
+            fake_len = fake_len.data.cpu().numpy()
+            generated.append((fake, fake_len))
+
+            embed_d = e_d(cseq, clen)
+            for x, length, real in [(samples, lengths, True), (fake, fake_len, False)]:
+                cls, _, _, nframes = d(to_variable(x, like), to_variable(length, like, NP.int64), embed_d)
+                correct, total = _frame_accuracy(cls.data.cpu().numpy(), nframes.data.cpu().numpy(), real)
+                if real:
+                    correct_real += correct
+                    total_real += total
+                else:
+                    correct_fake += correct
+                    total_fake += total
+
+            distances.append(log_spectral_distance(real_spectra, log_spectrum(fake, fake_len)))
+            length_errors.append(NP.abs(fake_len - lengths) / NP.maximum(lengths, 1).astype(float))
+
+    metrics = {
+            'acc_d': float(correct_real) / total_real,
+            'acc_g': float(correct_fake) / total_fake,
+            'log_spectral_distance': NP.concatenate(distances).mean(),
+            'length_error': NP.concatenate(length_errors).mean(),
+            }
+    return metrics, generated
+
+
+class Evaluator(object):
+    '''
+    Evaluates every new checkpoint under @prefix on a background thread.
+
+    build_models: returns a fresh dict of models to load checkpoints into,
+            so that the models being trained are never touched
+    writer: Tensorboard writer for the metrics, tagged eval/<name>
+    interval: seconds between checks for a new checkpoint
+    '''
+    def __init__(self, prefix, build_models, evalset, writer, interval=30):
+        self.prefix = prefix
+        self.build_models = build_models
+        self.evalset = evalset
+        self.writer = writer
+        self.interval = interval
+        self.last_step = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        models = self.build_models()
+        for m in models.values():
+            m.eval()
+        while not self._stop.is_set():
+            step, path = checkpoint.latest_checkpoint(self.prefix)
+            if step is not None and step != self.last_step:
+                try:
+                    self.evaluate_checkpoint(models, step, path)
+                except Exception as e:
+                    # A checkpoint can be pruned before it is read; the next
+                    # one will be picked up.
+                    print 'Evaluation of %s failed: %r' % (path, e)
+                self.last_step = step
+            self._stop.wait(self.interval)
+
+    def evaluate_checkpoint(self, models, step, path):
+        checkpoint.load_checkpoint(path, models, {})
+        metrics, _ = evaluate(models, self.evalset)
+        self.writer.add_summary(
+                TF.Summary(value=[
+                    TF.Summary.Value(tag='eval/%s' % k, simple_value=v) for k, v in sorted(metrics.items())]),
+                step)
+        print 'Eval', step, ' '.join('%s=%.4f' % (k, v) for k, v in sorted(metrics.items()))
@@ -0,0 +1,84 @@
+
+import numpy as NP
+import torch as T
+
+
+def _grads(params):
+    return [p.grad.data for p in params if p.grad is not None]
+
+
+def _grad_stats(grads, overflow):
+    '''
+    Returns a (2, len(grads)) device tensor holding the L2 norm of every
+    gradient, and whether any of its elements exceeds @overflow in absolute
+    value.  NaN and inf show up as non-finite norms.
+    '''
+    if hasattr(T, '_foreach_norm'):
+        norms = T.stack(T._foreach_norm(grads))
+        maxabs = T.stack(T._foreach_norm(grads, float('inf')))
+        return T.stack([norms, (maxabs > overflow).type_as(norms)])
+
+    # One reduction per gradient, without copying any of them; the results
+    # stay on the device until the single transfer in clip_grads().
+    sq = T.cat([g.view(-1).pow(2).sum(0).view(1) for g in grads])
+    maxabs = T.cat([g.view(-1).abs().max(0)[0].view(1) for g in grads])
+    return T.stack([sq.sqrt(), (maxabs > overflow).type_as(sq)])
+
+
+def _scale_grads(grads, factors):
+    if hasattr(T, '_foreach_mul_'):
+        T._foreach_mul_(grads, [float(f) for f in factors])
+    else:
+        for g, f in zip(grads, factors):
+            if f != 1:
+                g.mul_(float(f))
+
+
+class GradHealth(object):
+    '''
+    norms: per-parameter gradient norms (before clipping)
+    norm: the norm reported for the clipping mode, i.e. the sum of the
+          per-parameter norms for 'tensor' and the global norm for 'global'
+    finite: whether all gradients are free of NaN and inf
+    overflow: whether any gradient element exceeds the overflow threshold
+    '''
+    def __init__(self, norms, overflow, mode):
+        self.norms = norms
+        self.total_norm = NP.sqrt((norms ** 2).sum())
+        self.norm = norms.sum() if mode == 'tensor' else self.total_norm
+        self.finite = bool(NP.isfinite(norms).all())
+        self.overflow = bool(overflow.any())
+
+
+def clip_grads(params, clip_norm, mode='tensor', overflow=1e+5):
+    '''
+    Checks and clips the gradients of @params with a few batched reductions
+    and a single transfer to the host.
+
+    mode: 'tensor' rescales each gradient whose norm exceeds @clip_norm on
+          its own, 'global' rescales all gradients by the same factor so that
+          their global norm does not exceed @clip_norm.  0 disables clipping.
+
+    Gradients are left untouched if any of them is not finite.
+    '''
+    grads = _grads(params)
+    if len(grads) == 0:
+        return GradHealth(NP.zeros(0), NP.zeros(0), mode)
+
+    stats = _grad_stats(grads, overflow).cpu().numpy()
+    health = GradHealth(stats[0], stats[1] > 0, mode)
+    if not health.finite:
+        return health
+
+    norms = health.norms
+    if clip_norm == 0:
+        factors = NP.ones_like(norms)
+    elif mode == 'tensor':
+        factors = NP.minimum(clip_norm / NP.maximum(norms, 1e-12), 1)
+    elif mode == 'global':
+        factors = NP.ones_like(norms) * min(clip_norm / max(health.total_norm, 1e-12), 1)
+    else:
+        raise ValueError('unknown clipping mode %s' % mode)
+
+    _scale_grads(grads, factors)
+    return health
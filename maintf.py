@@ -7,6 +7,7 @@ import numpy as NP
 import numpy.random as RNG
 
 import argparse
+import json
 import sys
 import datetime
 import os
@@ -74,6 +75,11 @@ parser.add_argument('--just_run', type=str, default='')
 parser.add_argument('--loaditerations', type=int)
 parser.add_argument('--logdir', type=str, default='.', help='log directory')
 parser.add_argument('--subset', type=int, default=0)
+parser.add_argument('--subset_cache', type=int, default=0, help='# of --subset rows to keep in an LRU cache (0 to disable)')
+parser.add_argument('--crop_threshold', type=float, default=None,
+                    help='keep cropped windows with more than half of the amplitudes above this (default: the threshold saved by preprocess.py)')
+parser.add_argument('--crop_align', type=int, default=1, help='cropped windows start at multiples of this many amplitudes')
+parser.add_argument('--seed', type=int, default=None, help='seed of the data order (default: random)')
 parser.add_argument('--metric', type=str, default='l2_loss')
 parser.add_argument('--dataset', type=str, default='dataset.h5')
 parser.add_argument('--conditional', action='store_true')
@@ -98,12 +104,20 @@ print modelnamesave
 print args
 
 batch_size = args.batchsize
+if args.seed is not None:
+    RNG.seed(args.seed)
 
 if args.conditional:
     maxlen, dataloader, dataloader_val = dataset.dataloader(batch_size, args)
 else:
     maxlen = args.amplitudes
-    _, dataloader, dataloader_val = dataset.dataloader(batch_size, args)
+    # Continue the data order of the loaded models, if it was saved
+    loader_state = {}
+    if modelnameload and os.path.exists('%s-data-%05d.json' % (modelnameload, args.loaditerations)):
+        with open('%s-data-%05d.json' % (modelnameload, args.loaditerations)) as f:
+            loader_state = json.load(f)
+    _, dataloader, dataloader_val = dataset.unconditional_dataloader(
+            batch_size, args, loader_state.get('train'), loader_state.get('valid'))
 
 # Log directories
 log_train_d, log_valid_d, log_train_g = util.logdirs(args.logdir, modelnamesave)
@@ -285,3 +299,6 @@ if __name__ == '__main__':
                 NP.save('%s%05d.npy' % (modelnamesave, i), x_gen)
                 g.save('%s-gen-%05d' % (modelnamesave, i))
                 d.save('%s-dis-%05d' % (modelnamesave, i))
+                if hasattr(dataloader, 'state'):
+                    with open('%s-data-%05d.json' % (modelnamesave, i), 'w') as f:
+                        json.dump({'train': dataloader.state(), 'valid': dataloader_val.state()}, f)
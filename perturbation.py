@@ -0,0 +1,50 @@
+
+import torch as T
+
+from timer import Timer
+
+
+class Perturbation(object):
+    '''
+    Adversarial perturbation of an input with signed first-order gradients,
+    as a stage that runs on its own schedule.
+
+    every: perturb on every @every-th iteration (0 disables the stage)
+    steps: number of signed-gradient steps per perturbation
+    budget: maximum absolute change of each element; every step moves by
+            @budget / @steps
+    threshold: gradient elements with absolute value not exceeding this are
+            treated as zero
+
+    The time spent is recorded by Timer under @name.
+    '''
+    def __init__(self, name, every=2, steps=1, budget=1e-3, threshold=0):
+        self.name = name
+        self.every = every
+        self.steps = steps
+        self.budget = budget
+        self.threshold = threshold
+
+    def active(self, iteration):
+        return self.every > 0 and iteration % self.every == 0
+
+    def perturb(self, x, loss_fn):
+        '''
+        loss_fn: maps the perturbed input to a loss tensor, whose sum the
+            perturbation tries to increase.
+
+        Returns the perturbed input as a new leaf variable.
+        '''
+        with Timer.new(self.name):
+            step_size = float(self.budget) / self.steps
+            x = x.data
+            delta = x.new(*x.size()).zero_()
+            for _ in range(self.steps):
+                x_adv = T.autograd.Variable(x + delta, requires_grad=True)
+                loss = loss_fn(x_adv).sum()
+                # Only the sign of the gradient is used, so no second-order
+                # graph is needed.
+                grad = T.autograd.grad(loss, x_adv, only_inputs=True)[0].data
+                step = (grad > self.threshold).type_as(x) - (grad < -self.threshold).type_as(x)
+                delta = (delta + step * step_size).clamp(-self.budget, self.budget)
+            return T.autograd.Variable(x + delta)
@@ -1,7 +1,9 @@
 #! /usr/bin/env python
 # Usage:
-# preprocess.py transcript_file_list_file sphere_file_list_file dataset
-# where dataset can be either an HDF5 file (suffixed by .h5) or a directory.
+# preprocess.py transcript_file_list_file sphere_file_list_file dataset [storage]
+# where dataset can be either an HDF5 file (suffixed by .h5) or a directory,
+# and storage is the sample format of an HDF5 file: float32 (default), int16
+# or mulaw (see storage.py).
 #
 # Put this program under the same directory as FAAValign.py
 # Also you need sph2pipe to uncompress the sphere files
@@ -18,10 +20,13 @@ import tempfile
 import logging
 import sh
 import shutil
+from storage import Storage
 
 NUM_WORKERS = 10
 sph2pipe = 'sph2pipe_v2.5/sph2pipe'
 faav_align = 'FAAValign.py'
+# Group holding the speaker id of every word segment (see dataset.SPEAKERS)
+SPEAKERS = '_speakers'
 
 def setup_workdir(workdir):
     shutil.copy('FAAValign.py', workdir)
@@ -30,8 +35,13 @@ def setup_workdir(workdir):
     shutil.copy('praat.py', workdir)
 
 class HDF5Writer(object):
-    def __init__(self, h5, buffer_slots=1000, buffer_size=1000):
+    '''
+    Values are stored with their own dtype, so audio is encoded by the
+    caller.
+    '''
+    def __init__(self, h5, buffer_slots=1000, buffer_size=1000, compression='gzip'):
         self.h5 = h5
+        self.compression = compression
         self.buffer = {}
         self.buffer_size = buffer_size
         self.buffer_slots = buffer_slots
@@ -42,8 +52,8 @@ class HDF5Writer(object):
             shape = [0] * (value.ndim + 1)
             maxshape = [None] * (value.ndim + 1)
             self.h5.create_dataset(
-                    dataset, shape=shape, dtype=NP.float32, maxshape=maxshape,
-                    compression='gzip')
+                    dataset, shape=shape, dtype=value.dtype, maxshape=maxshape,
+                    compression=self.compression)
         if dataset not in self.buffer:
             # Check if the buffer slots are full, and flush one buffer slot
             if len(self.buffer) == self.buffer_slots:
@@ -71,7 +81,7 @@ class HDF5Writer(object):
         # convert buffer list to numpy array
         maxshape = [max(s) for s in zip(*([shape[1:]] + [a.shape for a in self.buffer[victim]]))]
         buffer_recs = len(self.buffer[victim])
-        buffer_ = NP.zeros([buffer_recs] + maxshape)
+        buffer_ = NP.zeros([buffer_recs] + maxshape, dtype=self.h5[victim].dtype)
         for i, a in enumerate(self.buffer[victim]):
             pad_shape = [(0, maxshape[_] - a.shape[_]) for _ in range(len(maxshape))]
             a_pad = NP.pad(a, pad_shape, 'constant')
@@ -129,6 +139,8 @@ def worker(q, p, console, workdir):
             assert isinstance(tier, praat.IntervalTier)
             if tier.name().find('word') == -1:
                 continue
+            # Word tiers are named "<speaker> - word"
+            speaker = tier.name().split(' - ')[0].strip()
             nbi = [i for i in range(len(tier)) if tier[i].mark() != 'sp']
             with console:
                 print '%s: Non-blank intervals: %d' % (output, len(nbi))
@@ -146,11 +158,11 @@ def worker(q, p, console, workdir):
                 ends.append(str(int(interval.xmax() * 8000)))
                 words.append(interval.mark())
 
-            p.put((wav, ' '.join(starts), ' '.join(ends), ' '.join(words)))
+            p.put((wav, speaker, ' '.join(starts), ' '.join(ends), ' '.join(words)))
 
         sh.rm('-f', work_tran, work_wav, work_output, work_faavlog, work_errorlog)
 
-    p.put((None, None, None, None))
+    p.put((None, None, None, None, None))
 
 if __name__ == '__main__':
     trans = {}
@@ -195,7 +207,9 @@ if __name__ == '__main__':
     if sys.argv[3].endswith('.h5'):
         h5 = h5py.File(sys.argv[3], 'w')
         write_h5 = True
-        h5writer = HDF5Writer(h5)
+        fmt = Storage(sys.argv[4] if len(sys.argv) > 4 else 'float32')
+        fmt.mark(h5)
+        h5writer = HDF5Writer(h5, compression=fmt.compression)
     else:
         h5 = None
         write_h5 = False
@@ -204,6 +218,7 @@ if __name__ == '__main__':
 
     # Prepare for parallelizing multiple FAAValign.py jobs
     wordfreq = Counter()
+    speaker_ids = {}
     q = MP.Queue()
     p = MP.Queue()
     console = MP.Lock()
@@ -223,7 +238,7 @@ if __name__ == '__main__':
     # Take from output queue and write them to dataset
     done = 0
     while True:
-        wav, starts, ends, words = p.get()
+        wav, speaker, starts, ends, words = p.get()
         if wav is None:
             done += 1
             if done == NUM_WORKERS:
@@ -234,6 +249,8 @@ if __name__ == '__main__':
             ends = [int(s) for s in ends.split()]
             words = words.split()
             assert len(starts) == len(ends) == len(words)
+            # A speaker is one side of one conversation
+            speaker_id = speaker_ids.setdefault((os.path.basename(wav), speaker), len(speaker_ids))
             for start, end, word in zip(starts, ends, words):
                 wordfreq.update([word])
 
@@ -247,13 +264,15 @@ if __name__ == '__main__':
                     filename = os.path.join(target_dir, str(wordfreq[word]))
                     librosa.output.write_wav(filename, amp_output, sr=8000)
                 else:
-                    h5writer.append(word, amp_output)
+                    h5writer.append(word, fmt.encode(amp_output))
+                    h5writer.append(SPEAKERS + '/' + word, NP.array([speaker_id], dtype=NP.int32))
 
             with console:
                 print 'Wrote word segments:', ' '.join(words)
 
     print 'Total word segments', wordfreq
     print 'Number of different words', len(wordfreq)
+    print 'Number of speakers', len(speaker_ids)
 
     if write_h5:
         h5writer.close()
@@ -1,40 +1,41 @@
 
 # Usage:
-# python2 preprocess.py THRESHOLD DATASET-NAME FILELIST-NAME [SAMPLE-RATE]
+# python2 preprocess.py THRESHOLD DATASET-NAME FILELIST-NAME [SAMPLE-RATE] [STORAGE]
+# where STORAGE is float32 (default), int16 or mulaw (see storage.py).
+#
+# Every utterance is stored once, back to back in 'audio', and starts at
+# the corresponding entry of 'offsets' (which ends with the total length).
+# The loader crops random windows from them and keeps those with more than
+# half of the amplitudes above THRESHOLD, which is saved as an attribute.
 import sys
 import librosa
 import numpy as NP
 import h5py
+from storage import Storage
 
-data = []
 thres = float(sys.argv[1])
 if len(sys.argv) > 4:
     sr = int(sys.argv[4])
 else:
     sr = 8000
+fmt = Storage(sys.argv[5] if len(sys.argv) > 5 else 'float32')
 
 datafile = h5py.File(sys.argv[2], 'w')
-dataset = datafile.create_dataset('data', shape=(0, sr),
-                                  maxshape=(None, sr), dtype='float32',
-                                  compression='gzip')
-samples = 0
+fmt.mark(datafile)
+datafile.attrs['threshold'] = thres
+datafile.attrs['sample_rate'] = sr
+audio = datafile.create_dataset('audio', shape=(0,), maxshape=(None,),
+                                dtype=fmt.dtype, chunks=(sr,),
+                                compression=fmt.compression)
+offsets = [0]
 with open(sys.argv[3]) as filelist:
     for f in filelist:
         print f.strip()
         x, _ = librosa.core.load(f.strip(), sr=sr)
-        for i in range(0, x.shape[0] - sr + 1):
-            if (NP.abs(x[i:i+sr]) > thres).sum() > sr / 2:
-                data.append(x[i:i+sr])
-            if len(data) == sr:
-                old_shape = dataset.shape[0]
-                dataset.resize(old_shape + len(data), axis=0)
-                dataset[old_shape:] = data
-                samples += len(data)
-                data = []
-                print '%d samples' % samples
+        audio.resize(offsets[-1] + x.shape[0], axis=0)
+        audio[offsets[-1]:] = fmt.encode(x)
+        offsets.append(offsets[-1] + x.shape[0])
+        print '%d utterances, %d amplitudes' % (len(offsets) - 1, offsets[-1])
 
-if len(data) > 0:
-    old_shape = dataset.shape[0]
-    dataset.resize(old_shape + len(data), axis=0)
-    dataset[old_shape:] = data
+datafile.create_dataset('offsets', data=NP.array(offsets, dtype=NP.int64))
 datafile.close()
@@ -0,0 +1,81 @@
+
+# Sample storage formats of the HDF5 datasets.
+#
+# Amplitudes in [-1, 1] can be stored as float32, as int16 with a scale
+# factor, or as 8-bit mu-law codes.  The format is recorded in the 'storage'
+# and 'scale' attributes of the HDF5 file, and the loaders dequantize the
+# stored rows straight into their float32 batch buffers.  Zero amplitudes
+# are stored as zero codes in every format, so zero padding survives.
+
+import numpy as NP
+
+FORMATS = ['float32', 'int16', 'mulaw']
+MU = 255.
+
+
+class Storage(object):
+    '''
+    kind: one of FORMATS
+    scale: amplitude of one int16 step; taken from the file when reading
+    '''
+    def __init__(self, kind='float32', scale=None):
+        if kind not in FORMATS:
+            raise ValueError('unknown storage format %s' % kind)
+        self.kind = kind
+        if kind == 'float32':
+            self.dtype = NP.float32
+            self.scale = 1.
+        elif kind == 'int16':
+            self.dtype = NP.int16
+            self.scale = 1. / 32767 if scale is None else float(scale)
+        else:
+            self.dtype = NP.int8
+            self.scale = 1.
+            # Amplitude of every code, indexed by the code as uint8
+            codes = NP.arange(256).astype(NP.uint8).view(NP.int8) / 127.
+            codes = NP.clip(codes, -1, 1)
+            self._table = (NP.sign(codes) * ((1 + MU) ** NP.abs(codes) - 1) / MU).astype(NP.float32)
+
+    @classmethod
+    def of(cls, h5):
+        '''
+        The storage format of an HDF5 file; files without the attributes
+        hold float32.
+        '''
+        kind = h5.attrs.get('storage', 'float32')
+        if isinstance(kind, bytes):
+            kind = kind.decode('ascii')
+        return cls(str(kind), h5.attrs.get('scale', None))
+
+    def mark(self, h5):
+        h5.attrs['storage'] = self.kind
+        h5.attrs['scale'] = self.scale
+
+    @property
+    def compression(self):
+        # Quantized samples are left uncompressed, so reading them costs no
+        # decompression.
+        return 'gzip' if self.kind == 'float32' else None
+
+    def encode(self, x):
+        x = NP.asarray(x)
+        if self.kind == 'float32':
+            return x.astype(NP.float32)
+        elif self.kind == 'int16':
+            return NP.clip(NP.round(x / self.scale), -32767, 32767).astype(NP.int16)
+        else:
+            x = NP.clip(x, -1, 1)
+            y = NP.sign(x) * NP.log1p(MU * NP.abs(x)) / NP.log1p(MU)
+            return NP.round(y * 127).astype(NP.int8)
+
+    def decode(self, stored, out=None, gain=1.):
+        '''
+        Dequantizes @stored into float32 amplitudes multiplied by @gain, in
+        one pass, into @out if given.
+        '''
+        stored = NP.asarray(stored)
+        if self.kind == 'mulaw':
+            return NP.take(self._table * NP.float32(gain), stored.view(NP.uint8), out=out, mode='clip')
+        if out is None:
+            out = NP.empty(stored.shape, dtype=NP.float32)
+        return NP.multiply(stored, NP.float32(self.scale * gain), out=out)
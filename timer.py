@@ -1,8 +1,28 @@
 
 import time
+from collections import deque
 
 class Timer(object):
+    '''
+    Usage:
+
+        with Timer.new('train_d'):
+            with Timer.new('d_forward'):
+                ...
+
+    Nested timers are recorded under their full path ('train_d/d_forward').
+    Each timer keeps the durations of its last @window runs, from which
+    Timer.stats() and Timer.report() compute percentiles.
+
+    Set Timer.sync to a callable (e.g. torch.cuda.synchronize) to wait for
+    asynchronous device work before reading the clock.
+    '''
     timers = {}
+    history = {}
+    window = 1000
+    sync = None
+    _stack = []
+
     def __init__(self, name, print_=False):
         self.start = self.end = 0
         self.name = name
@@ -10,15 +30,25 @@ class Timer(object):
 
     @classmethod
     def new(cls, name, print_=False):
-        cls.timers[name] = Timer(name, print_)
-        return cls.timers[name]
+        path = '/'.join(cls._stack + [name])
+        cls.timers[path] = Timer(path, print_)
+        return cls.timers[path]
 
     def __enter__(self):
+        if Timer.sync is not None:
+            Timer.sync()
+        Timer._stack.append(self.name.split('/')[-1])
         self.start = time.time()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        if Timer.sync is not None:
+            Timer.sync()
         self.end = time.time()
+        Timer._stack.pop()
+        if self.name not in Timer.history:
+            Timer.history[self.name] = deque(maxlen=Timer.window)
+        Timer.history[self.name].append(self.end - self.start)
         if self.print_:
             print '%s: %.6fs' % (self.name, self.end - self.start)
 
@@ -27,6 +57,32 @@ class Timer(object):
         return ((cls.timers[name].end - cls.timers[name].start)
                 if name in cls.timers else 0)
 
+    @classmethod
+    def stats(cls, name, percentiles=(50, 95, 99)):
+        samples = sorted(cls.history.get(name, []))
+        if len(samples) == 0:
+            return None
+        result = {'count': len(samples), 'mean': sum(samples) / len(samples)}
+        for p in percentiles:
+            # nearest-rank percentile
+            rank = max(int(-(-p * len(samples) // 100)), 1)
+            result['p%d' % p] = samples[rank - 1]
+        return result
+
+    @classmethod
+    def report(cls):
+        return dict((name, cls.stats(name)) for name in cls.history)
+
+    @classmethod
+    def format_report(cls):
+        lines = ['%-32s %8s %10s %10s %10s %10s' % ('phase', 'count', 'mean', 'p50', 'p95', 'p99')]
+        for name, s in sorted(cls.report().items()):
+            lines.append('%-32s %8d %10.6f %10.6f %10.6f %10.6f' %
+                         (name, s['count'], s['mean'], s['p50'], s['p95'], s['p99']))
+        return '\n'.join(lines)
+
     @classmethod
     def reset(cls):
         cls.timers = {}
+        cls.history = {}
+        cls._stack = []
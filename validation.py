@@ -0,0 +1,100 @@
+
+# Validation of the discriminator on a fixed set of validation words.
+#
+# The validation examples are drawn once, sorted by audio length and packed
+# into large batches, each padded only to its own longest sample.  validate()
+# streams them through e_d and d without building a graph and reports the
+# classification loss and frame accuracy overall and per word length bucket.
+
+import numpy as NP
+
+import dataset
+from evaluation import no_grad, to_variable
+
+
+def _roundup(x, d):
+    return (x + d - 1) // d * d
+
+
+class ValidationSet(object):
+    '''
+    examples: list of (audio, word) with the audio trimmed to its length
+    batch_size: number of examples per batch
+    pad_multiple: batches are padded to a multiple of this many amplitudes
+    '''
+    def __init__(self, examples, batch_size, pad_multiple=1):
+        examples = sorted(examples, key=lambda e: len(e[0]))
+        self.batches = []
+        for start in range(0, len(examples), batch_size):
+            chunk = examples[start:start + batch_size]
+            lengths = NP.array([len(audio) for audio, _ in chunk])
+            samples = NP.zeros((len(chunk), _roundup(lengths.max(), pad_multiple)), dtype=NP.float32)
+            for i, (audio, _) in enumerate(chunk):
+                samples[i, :len(audio)] = audio
+            cseq, clen = dataset.encode_words([word for _, word in chunk])
+            self.batches.append((samples, lengths, cseq, clen))
+
+    @classmethod
+    def from_loader(cls, loader, nbatches, batch_size, pad_multiple=1):
+        '''
+        Draws @nbatches batches from the validation data loader and repacks
+        them into batches of @batch_size.
+        '''
+        examples = []
+        for _ in range(nbatches):
+            _, _, samples, lengths, words, _, _ = loader.next()
+            # The loader refills its batch arrays, so the audio is copied
+            examples.extend((samples[i, :lengths[i]].copy(), words[i]) for i in range(len(words)))
+        return cls(examples, batch_size, pad_multiple)
+
+
+def bucket_names(boundaries):
+    '''
+    Names of the word length buckets delimited by the (inclusive) upper
+    bounds @boundaries, e.g. [3, 6] gives len1-3, len4-6 and len7+.
+    '''
+    lower = [1] + [b + 1 for b in boundaries]
+    return ['len%d-%d' % (l, u) for l, u in zip(lower, boundaries)] + ['len%d+' % lower[-1]]
+
+
+def validate(d, e_d, valset, boundaries, target=0.9):
+    '''
+    Returns the mean classification loss of d on the real validation audio
+    against @target (as for real audio in training), and the fraction of
+    frames classified as real, overall and per word length bucket.
+    '''
+    like = next(d.parameters()).data
+    losses = []
+    correct = []
+    total = []
+    word_lengths = []
+    with no_grad():
+        for samples, lengths, cseq, clen in valset.batches:
+            embed_d = e_d(to_variable(cseq, like, NP.int64), to_variable(clen, like, NP.int64))
+            cls, _, _, nframes = d(to_variable(samples, like), to_variable(lengths, like, NP.int64), embed_d)
+            cls = cls.data.cpu().numpy().astype(NP.float64)
+            nframes = nframes.data.cpu().numpy()
+            weight = NP.arange(cls.shape[1])[NP.newaxis] < nframes[:, NP.newaxis]
+            # Binary cross entropy with logits, as in training
+            loss = NP.maximum(cls, 0) - cls * target + NP.log1p(NP.exp(-NP.abs(cls)))
+            losses.append((loss * weight).sum(1) / nframes)
+            correct.append(((cls > 0) * weight).sum(1))
+            total.append(weight.sum(1))
+            word_lengths.append(clen)
+
+    losses = NP.concatenate(losses)
+    correct = NP.concatenate(correct)
+    total = NP.concatenate(total)
+    buckets = NP.searchsorted(boundaries, NP.concatenate(word_lengths), side='left')
+    nbuckets = len(boundaries) + 1
+    count = NP.bincount(buckets, minlength=nbuckets)
+    bucket_loss = NP.bincount(buckets, weights=losses, minlength=nbuckets)
+    bucket_correct = NP.bincount(buckets, weights=correct, minlength=nbuckets)
+    bucket_total = NP.bincount(buckets, weights=total, minlength=nbuckets)
+
+    metrics = {'loss': losses.mean(), 'acc': float(correct.sum()) / total.sum()}
+    for i, name in enumerate(bucket_names(boundaries)):
+        if count[i] > 0:
+            metrics['loss/%s' % name] = bucket_loss[i] / count[i]
+            metrics['acc/%s' % name] = bucket_correct[i] / bucket_total[i]
+    return metrics